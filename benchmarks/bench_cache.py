@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Benchmark of cache lookups of program details.
+
+Looks up cached details of N programs the way details stage does,
+`--parallel` coroutines at once, and reports wall time along with
+CPU time of the event loop thread, the time lookups block it for:
+
+- diskcache: pickled models, one `get` per coroutine (before the store);
+- store: compressed JSON, one query per coroutine;
+- store, prefetched: bulk reads per channel schedule in a thread,
+  coroutines take entries from in-memory LRU.
+
+Usage:
+    python benchmarks/bench_cache.py --programs 10000 50000
+"""
+
+import argparse
+import asyncio
+import pathlib
+import sys
+import tempfile
+import time
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from diskcache import Cache  # noqa: E402
+
+import models.tvguide  # noqa: E402
+from bench_epg import make_details  # noqa: E402
+from epg_cache import CacheEntry  # noqa: E402
+from epg_store import CompactStore, StoreCache  # noqa: E402
+
+TTL = 3600
+
+
+def fill(dirpath, program_ids):
+    """Cache details of programs both ways."""
+    disk_cache = Cache(str(dirpath / 'diskcache'))
+    store = CompactStore(dirpath / 'store.db')
+    items = []
+    for pid in program_ids:
+        details = models.tvguide.ProgramDetails(**make_details(pid, posters=100))
+        disk_cache.set(str(pid), CacheEntry(details, time.time() + TTL), expire=TTL)
+        items.append(('details', str(pid), CacheEntry(details.dict(), time.time() + TTL), TTL))
+    store.set_many(items)
+    return disk_cache, store
+
+
+async def lookup_all(program_ids, get, parallel, prefetch=None, channel_size=12):
+    """Look up details of all programs with `parallel` coroutines."""
+    queue = asyncio.Queue()
+    for idx in range(0, len(program_ids), channel_size):
+        # Schedules come channel by channel
+        keys = [str(pid) for pid in program_ids[idx:idx + channel_size]]
+        if prefetch:
+            prefetch(keys)
+        for key in keys:
+            queue.put_nowait(key)
+
+    async def work():
+        while not queue.empty():
+            entry = await get(queue.get_nowait())
+            assert entry and entry.value
+            await asyncio.sleep(0)  # Request goes here
+
+    await asyncio.gather(*[work() for _ in range(parallel)])
+
+
+def measure(program_ids, parallel, make_get):
+    """Wall and event loop CPU time of looking up all programs."""
+    async def run():
+        get, prefetch = make_get()
+        await lookup_all(program_ids, get, parallel, prefetch)
+
+    started_at, cpu_started_at = time.perf_counter(), time.thread_time()
+    asyncio.run(run())
+    return time.perf_counter() - started_at, time.thread_time() - cpu_started_at
+
+
+def run(programs, parallel):
+    program_ids = list(range(1, programs + 1))
+    with tempfile.TemporaryDirectory(prefix='bench-cache-') as tmpdir:
+        disk_cache, store = fill(pathlib.Path(tmpdir), program_ids)
+
+        def diskcache():
+            async def get(key):
+                return disk_cache.get(key)
+
+            return get, None
+
+        def store_by_key():
+            async def get(key):
+                return store.get('details', key)
+
+            return get, None
+
+        def store_prefetched():
+            store_cache = StoreCache(store, namespaces={'details'}, max_entries=programs)
+
+            async def get(key):
+                return await store_cache.get('details', key)
+
+            return get, lambda keys: store_cache.prefetch('details', keys)
+
+        results = {}
+        for name, make_get in [('diskcache', diskcache), ('store', store_by_key),
+                               ('store, prefetched', store_prefetched)]:
+            results[name] = measure(program_ids, parallel, make_get)
+
+        disk_cache.close()
+        store.close()
+
+    print(f'\n{programs} programs, {parallel} coroutines')
+    print(f'  {"lookups":<20} {"wall, s":>9} {"loop CPU, s":>12} {"per lookup, us":>15}')
+    for name, (wall, cpu) in results.items():
+        print(f'  {name:<20} {wall:>9.3f} {cpu:>12.3f} {cpu / programs * 10**6:>15.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser('bench-cache')
+    parser.add_argument('--programs', metavar='N', type=int, nargs='+', default=[10000],
+                        help='Numbers of programs to look up (default: %(default)s)')
+    parser.add_argument('--parallel', metavar='N', type=int, default=10,
+                        help='Number of coroutines looking up (default: %(default)s)')
+    args = parser.parse_args()
+
+    for programs in args.programs:
+        run(programs, args.parallel)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""Offline end-to-end benchmark of EPG downloader.
+
+Every run replays synthetic dataset, `channels.json` scaled N times,
+from local stand-in server and reports wall time, requests per second
+and peak RSS for each stage.
+
+Usage:
+    python benchmarks/bench_epg.py --scales 1 10 50
+"""
+
+import argparse
+import asyncio
+import functools
+import gzip
+import hashlib
+import io
+import json
+import logging
+import pathlib
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
+
+# Files of the tree needed for a run
+TREE_FILES = ['epg_*.py', 'ustvgo_iptv.py', 'models/**/*.py',
+              'images/icons/*.json', 'images/icons/**/*.png', 'resources/*']
+
+STAGES = ['schedules', 'details', 'cast', 'images', 'tags', 'xml', 'gzip']
+
+# Stages by request URL
+STAGE_URL_PATTERNS = {
+    'schedules': '/tvguide/JSON2/',
+    'details': '/programdetails/',
+    'cast': '/shows-cast/',
+    'images': '/a/img/catalog/',
+    'tags': '/tvschedules/tvguide/9100001138/',
+}
+
+PROVIDER_TAGS_URL = ('https://cmg-prod.apigee.net/v1/xapi/tvschedules'
+                     '/tvguide/9100001138/web?start=0&duration=720')
+POSTERS_MAX = 2000
+POSTER_COLORS = ['red', 'green', 'blue', 'orange', 'purple', 'teal', 'gray', 'navy']
+
+
+def program_id(tvguide_id, idx, programs_per_channel):
+    """Program ID, a quarter of programs are repeated airings."""
+    key = f'{tvguide_id}:{idx % max(1, programs_per_channel * 3 // 4)}'
+    return int(hashlib.sha1(key.encode()).hexdigest(), 16) % 10**9
+
+
+def make_details(pid, posters):
+    return {
+        'id': pid, 'name': f'Program {pid}', 'parentId': None, 'description': 'Description',
+        'isSportsEvent': False, 'rating': None, 'tvRating': 'TV-PG', 'episodeTitle': 'Episode',
+        'releaseYear': 2000 + pid % 20, 'categoryId': 1, 'subCategoryId': 1,
+        'episodeAirDate': '/Date(1650000000000+0000)/', 'episodeNumber': pid % 20 + 1,
+        'seasonNumber': pid % 5 + 1, 'mcoId': pid % 5000 + 1, 'title': None, 'type': None,
+        'slug': None, 'typeId': None,
+        'images': [{
+            'id': str(pid), 'provider': 'synthetic', 'bucketType': 'catalog',
+            'imageType': {'typeId': 1, 'typeName': 'showcard', 'providerTypeName': 'showcard'},
+            'bucketPath': f'/synthetic/{pid % posters}.jpg', 'filename': f'{pid % posters}.jpg',
+            'width': 1000, 'height': 562,
+        }],
+        'genres': [{'id': 1, 'name': 'Drama', 'genres': ['crime drama', 'science fiction & fantasy']}],
+        'duration': 1800, 'metacriticSummary': {'url': None, 'score': pid % 100, 'reviewCount': 1},
+        'video': None,
+    }
+
+
+def make_cast(mco_id):
+    return {'components': [{
+        'meta': {'componentName': 'tv-object-cast-and-crew'},
+        'data': {'id': str(mco_id), 'items': [
+            {'id': mco_id * 10 + i, 'name': f'Person {i}', 'role': f'Role {i}',
+             'type': 'Actor' if i else 'Director'}
+            for i in range(8)
+        ]},
+    }]}
+
+
+def make_dataset(dirpath, scale, programs_per_channel):
+    """Write channels file and recordings of synthetic dataset."""
+    sys.path.insert(0, str(ROOT_DIR))
+    from PIL import Image
+
+    from epg_replay import Recorder
+
+    channels = json.loads((ROOT_DIR / 'channels.json').read_text(encoding='utf-8'))
+    scaled_channels = []
+    for copy_idx in range(scale):
+        for channel in channels:
+            suffix = f'_{copy_idx}' if copy_idx else ''
+            tvguide_id = channel['tvguide_id']
+            scaled_channels.append({
+                **channel,
+                'id': len(scaled_channels) + 1,
+                'stream_id': channel['stream_id'] + suffix,
+                'tvguide_id': f'{tvguide_id}{copy_idx:03d}' if tvguide_id and copy_idx else tvguide_id,
+            })
+
+    channels_path = dirpath / 'channels.json'
+    channels_path.write_text(json.dumps(scaled_channels), encoding='utf-8')
+
+    recorder = Recorder(dirpath / 'recordings')
+    json_headers = {'Content-Type': 'application/json', 'ETag': '"synthetic"'}
+
+    def record_json(url, data):
+        recorder.record(url, 200, json_headers, json.dumps(data).encode('utf-8'))
+
+    start_ts = int(time.time()) // 1800 * 1800
+    tvguide_ids = sorted({c['tvguide_id'] for c in scaled_channels if c['tvguide_id']})
+    program_ids = set()
+    for tvguide_id in tvguide_ids:
+        programs = []
+        for idx in range(programs_per_channel):
+            pid = program_id(tvguide_id, idx, programs_per_channel)
+            program_ids.add(pid)
+            programs.append({
+                'id': pid, 'name': f'Program {pid}', 'image': '', 'color': 1,
+                'start_timestamp': start_ts + idx * 1800, 'end_timestamp': start_ts + (idx + 1) * 1800,
+                'description': 'Description', 'day': 'Today', 'start_time': '', 'end_time': '',
+            })
+        record_json(f'https://ustvgo.tv/tvguide/JSON2/{tvguide_id}.json', {'items': {'Today': programs}})
+
+    posters = max(1, min(POSTERS_MAX, len(program_ids) // 3))
+    mco_ids = set()
+    for pid in program_ids:
+        details = make_details(pid, posters)
+        mco_ids.add(details['mcoId'])
+        record_json('https://cmg-prod.apigee.net/v1/xapi/tvschedules/'
+                    'tvguide/programdetails/%d/web' % pid, {'data': {'item': details}})
+
+    for mco_id in mco_ids:
+        record_json('https://cmg-prod.apigee.net/v1/xapi/composer/tvguide/pages/'
+                    'shows-cast/%d/web?contentOnly=true' % mco_id, make_cast(mco_id))
+
+    poster_bodies = []
+    for color in POSTER_COLORS:
+        bytesio = io.BytesIO()
+        Image.new('RGB', (1000, 562), color).save(bytesio, format='JPEG', quality=90)
+        poster_bodies.append(bytesio.getvalue())
+
+    for idx in range(posters):
+        recorder.record(f'https://www.tvguide.com/a/img/catalog/synthetic/{idx}.jpg', 200,
+                        {'Content-Type': 'image/jpeg', 'ETag': f'"{idx}"'},
+                        poster_bodies[idx % len(poster_bodies)])
+
+    record_json(PROVIDER_TAGS_URL, {'data': {'items': [{'programSchedules': [
+        {'programId': pid, 'startTime': start_ts, 'airingAttrib': 0b101}
+        for pid in sorted(program_ids)[::7]
+    ]}]}})
+
+    return channels_path, len(program_ids)
+
+
+def peak_rss_mb():
+    """Peak RSS of the process and of its children (image workers), MB."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return usage / scale, usage_children / scale
+
+
+def run_worker(dirpath, args):
+    """Run downloader from the tree copy in `dirpath`, print measurements as JSON."""
+    sys.path.insert(0, str(dirpath / 'tree'))
+    import epg_downloader
+    import epg_http
+    from epg_replay import ReplayServer
+    from ustvgo_iptv import logger
+
+    # Scaled channels have no icons
+    logger.setLevel(logging.ERROR)
+
+    spans = {}
+
+    def timed(stage, func):
+        """Record span of stage function calls."""
+        def update(started_at):
+            span = spans.setdefault(stage, {'started_at': started_at, 'calls': 0})
+            span['finished_at'] = time.perf_counter()
+            span['calls'] += 1
+            span['peak_rss_mb'], span['peak_rss_children_mb'] = peak_rss_mb()
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def inner(*a, **kw):
+                started_at = time.perf_counter()
+                try:
+                    return await func(*a, **kw)
+                finally:
+                    update(started_at)
+        else:
+            @functools.wraps(func)
+            def inner(*a, **kw):
+                started_at = time.perf_counter()
+                try:
+                    return func(*a, **kw)
+                finally:
+                    update(started_at)
+
+        return inner
+
+    for stage, name in [('schedules', 'download_programs'), ('details', 'download_program_detail'),
+                        ('cast', 'download_program_cast'), ('images', 'download_program_images'),
+                        ('tags', 'download_program_tags'), ('xml', 'make_xmltv')]:
+        setattr(epg_downloader, name, timed(stage, getattr(epg_downloader, name)))
+
+    if not args.rate_limits:
+        for host, policy in epg_http.HOST_POLICIES.items():
+            epg_http.HOST_POLICIES[host] = policy._replace(rate=0)
+
+    output = dirpath / 'tree' / 'ustvgo.xml'
+
+    async def run():
+        server = ReplayServer(dirpath / 'recordings', latency=args.latency / 1000,
+                              error_rate=args.error_rate)
+        async with server:
+            await epg_downloader.download_and_make_epg(
+                outputs=[(output, False)], parallel=args.parallel, create_archive=True,
+                images_size=720, images_quality=80, images_grace_period=0,
+                image_workers=args.image_workers, base_url='http://localhost',
+                channels_file=str(dirpath / 'channels.json'), replay=server.url,
+            )
+        return server.hits
+
+    started_at = time.perf_counter()
+    hits = asyncio.run(run())
+    wall = time.perf_counter() - started_at
+
+    # Archive is written along with XML, measure compression alone
+    data = output.read_bytes()
+    gzip_started_at = time.perf_counter()
+    gzip.compress(data)
+    spans['gzip'] = {'started_at': gzip_started_at, 'finished_at': time.perf_counter(), 'calls': 1}
+    spans['gzip']['peak_rss_mb'], spans['gzip']['peak_rss_children_mb'] = peak_rss_mb()
+
+    stages = {}
+    for stage in STAGES:
+        span = spans.get(stage)
+        if not span:
+            continue
+
+        pattern = STAGE_URL_PATTERNS.get(stage)
+        requests = sum(n for url, n in hits.items() if pattern and pattern in url)
+        stage_wall = span['finished_at'] - span['started_at']
+        stages[stage] = {
+            'wall': stage_wall,
+            'calls': span['calls'],
+            'requests': requests,
+            'rps': requests / stage_wall if stage_wall > 0 else 0.0,
+            'peak_rss_mb': span['peak_rss_mb'],
+            'peak_rss_children_mb': span['peak_rss_children_mb'],
+        }
+
+    peak_rss, peak_rss_children = peak_rss_mb()
+    print(json.dumps({
+        'wall': wall, 'requests': sum(hits.values()), 'output_bytes': len(data),
+        'peak_rss_mb': peak_rss, 'peak_rss_children_mb': peak_rss_children, 'stages': stages,
+    }))
+
+
+def copy_tree(dirpath):
+    """Copy files needed for a run, so posters and cache are kept apart."""
+    for pattern in TREE_FILES:
+        for filepath in ROOT_DIR.glob(pattern):
+            target = dirpath / filepath.relative_to(ROOT_DIR)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(filepath, target)
+
+
+def print_report(scale, programs, result):
+    print(f'\nScale {scale}x: {programs} programs, {result["requests"]} requests, '
+          f'{result["wall"]:.2f} s, peak RSS {result["peak_rss_mb"]:.0f} MB '
+          f'(image workers {result["peak_rss_children_mb"]:.0f} MB)')
+    print(f'  {"stage":<10} {"wall, s":>9} {"requests":>9} {"req/s":>9} {"peak RSS, MB":>13}')
+    for stage in STAGES:
+        if stage in result['stages']:
+            s = result['stages'][stage]
+            print(f'  {stage:<10} {s["wall"]:>9.2f} {s["requests"]:>9} '
+                  f'{s["rps"]:>9.1f} {s["peak_rss_mb"]:>13.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser('bench-epg')
+    parser.add_argument('--scales', metavar='N', type=int, nargs='+', default=[1, 10, 50],
+                        help='Scales of channels.json to run against (default: %(default)s)')
+    parser.add_argument('--programs-per-channel', metavar='N', type=int, default=12,
+                        help='Programs per channel (default: %(default)s)')
+    parser.add_argument('--parallel', metavar='N', type=int, default=10,
+                        help='Number of parallel workers per download stage (default: %(default)s)')
+    parser.add_argument('--image-workers', metavar='N', type=int, default=2,
+                        help='Number of processes resizing images (default: %(default)s)')
+    parser.add_argument('--latency', metavar='MS', type=int, default=0,
+                        help='Delay responses by MS milliseconds (default: %(default)s)')
+    parser.add_argument('--error-rate', metavar='P', type=float, default=0,
+                        help='Fail responses with probability P (default: %(default)s)')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='Keep rate limits of hosts')
+    parser.add_argument('--json', metavar='FILE', type=pathlib.Path,
+                        help='Save results into FILE')
+    parser.add_argument('--worker', metavar='DIR', type=pathlib.Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args)
+        return
+
+    results = []
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory(prefix='bench-epg-') as tmpdir:
+            dirpath = pathlib.Path(tmpdir)
+            copy_tree(dirpath / 'tree')
+            _, programs = make_dataset(dirpath, scale, args.programs_per_channel)
+
+            # Separate process per scale for honest peak RSS
+            worker_args = [sys.executable, __file__, '--worker', str(dirpath)] + [
+                f'--parallel={args.parallel}', f'--image-workers={args.image_workers}',
+                f'--latency={args.latency}', f'--error-rate={args.error_rate}',
+            ] + (['--rate-limits'] if args.rate_limits else [])
+            completed = subprocess.run(worker_args, stdout=subprocess.PIPE, check=True)
+            result = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+
+        result.update(scale=scale, programs=programs)
+        results.append(result)
+        print_report(scale, programs, result)
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2), encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
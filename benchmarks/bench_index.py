@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Benchmark of reading programmes of one channel out of XMLTV document.
+
+Reads programmes of every channel of the document, one channel at a time,
+and programmes overlapping a time window, reports time per lookup:
+
+- parse: the whole document is parsed by lxml for every lookup;
+- index: `XmltvReader` pulls programmes by the sidecar index.
+
+Usage:
+    python benchmarks/bench_index.py ustvgo.for-dark-bg.xml
+    python benchmarks/bench_index.py ustvgo.for-dark-bg.xml --channels 10
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from lxml import etree as ET  # noqa: E402
+
+from epg_xmltv import XmltvReader  # noqa: E402
+
+
+def parse_channel(filepath, channel_id):
+    return [ET.tostring(element) for element in ET.parse(str(filepath)).getroot()
+            if element.tag == 'programme' and element.get('channel') == channel_id]
+
+
+def main():
+    parser = argparse.ArgumentParser('bench-index')
+    parser.add_argument('filepath', metavar='FILE', type=pathlib.Path,
+                        help='XMLTV document made along with its index')
+    parser.add_argument('--channels', metavar='N', type=int, default=20,
+                        help='Number of channels to look up (default: %(default)s)')
+    parser.add_argument('--window', metavar='SECONDS', type=int, default=3600,
+                        help='Time window of programmes to look up (default: %(default)s)')
+    args = parser.parse_args()
+
+    with XmltvReader(args.filepath) as reader:
+        channel_ids = list(reader.channels)[:args.channels]
+        start = min(reader.span(channel_id)[0] for channel_id in channel_ids)
+
+        lookups = [
+            ('parse', lambda channel_id: parse_channel(args.filepath, channel_id)),
+            ('index', reader.channel),
+            ('window', lambda channel_id: list(reader.programmes(start, start + args.window,
+                                                                 [channel_id]))),
+        ]
+
+        print(f'{args.filepath}: {args.filepath.stat().st_size / 2**20:.1f} MB, '
+              f'{len(channel_ids)} channels')
+        print(f'  {"lookup":<8} {"total, s":>9} {"per channel, ms":>16}')
+        for name, lookup in lookups:
+            started_at = time.perf_counter()
+            for channel_id in channel_ids:
+                lookup(channel_id)
+            seconds = time.perf_counter() - started_at
+            print(f'  {name:<8} {seconds:>9.3f} {seconds / len(channel_ids) * 1000:>16.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Benchmark of making program details and cast models.
+
+Makes models of N programs two ways and reports time and memory
+they take per 10k programs:
+
+- pydantic: downloaded payload, validated by pydantic models;
+- lean: payload validated already and read back from our own cache,
+  made into lean models without validation.
+
+With --baseline, payload is also validated by pydantic models of
+the given git revision, e.g. full models from before they were trimmed.
+
+Usage:
+    python benchmarks/bench_models.py --programs 10000
+    python benchmarks/bench_models.py --baseline f6e0a97^
+"""
+
+import argparse
+import gc
+import importlib
+import io
+import pathlib
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+import models.tvguide  # noqa: E402
+from bench_epg import make_cast, make_details  # noqa: E402
+
+
+def import_models(revision, directory):
+    """Import `models` package of git revision as `baseline_models`."""
+    archive = subprocess.run(['git', 'archive', revision, 'models'], cwd=ROOT_DIR,
+                             check=True, stdout=subprocess.PIPE).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+    (pathlib.Path(directory) / 'models').rename(pathlib.Path(directory) / 'baseline_models')
+    sys.path.insert(0, directory)
+    return importlib.import_module('baseline_models.tvguide')
+
+
+def measure(make, payloads):
+    """Seconds and bytes taken by models of payloads."""
+    gc.collect()
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    made = [make(payload) for payload in payloads]
+    seconds = time.perf_counter() - started_at
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del made
+
+    # Time once more, without tracing
+    started_at = time.perf_counter()
+    [make(payload) for payload in payloads]
+    return min(seconds, time.perf_counter() - started_at), size
+
+
+def main():
+    parser = argparse.ArgumentParser('bench-models')
+    parser.add_argument('--programs', metavar='N', type=int, default=10000,
+                        help='Number of programs (default: %(default)s)')
+    parser.add_argument('--baseline', metavar='REV',
+                        help='Also validate by pydantic models of git revision')
+    args = parser.parse_args()
+
+    details = [make_details(pid, posters=100) for pid in range(1, args.programs + 1)]
+    for item in details:
+        item['video'] = {
+            'videoId': item['id'], 'providerId': 1, 'title': 'Trailer', 'slug': 'trailer',
+            'type': 'trailer', 'contentType': 'video', 'contentTypeId': 1,
+            'videoTitle': 'Trailer', 'url': 'https://example.com/trailer', 'duration': 120,
+            'originalAirDate': None, 'seasonNumber': 1, 'episodeNumber': 1,
+            'images': [{'imageUrl': 'https://example.com/trailer.jpg', 'width': 640, 'height': 360}],
+        }
+    casts = [make_cast(item['mcoId'])['components'][0]['data'] for item in details]
+
+    # What loaders store in the cache
+    trusted_details = [models.tvguide.ProgramDetails(**item).dict() for item in details]
+    trusted_casts = [models.tvguide.ShowsCast(**item).dict() for item in casts]
+
+    ProgramDetails, ShowsCast = models.tvguide.ProgramDetails, models.tvguide.ShowsCast
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench-models-') as directory:
+        if args.baseline:
+            baseline = import_models(args.baseline, directory)
+            results.append((f'details, {args.baseline}',
+                            measure(lambda item: baseline.ProgramDetails(**item), details)))
+        results += [
+            ('details, pydantic', measure(lambda item: ProgramDetails(**item), details)),
+            ('details, lean', measure(models.tvguide.LeanProgramDetails, trusted_details)),
+        ]
+        if args.baseline:
+            results.append((f'cast, {args.baseline}',
+                            measure(lambda item: baseline.ShowsCast(**item), casts)))
+        results += [
+            ('cast, pydantic', measure(lambda item: ShowsCast(**item), casts)),
+            ('cast, lean', measure(models.tvguide.LeanShowsCast, trusted_casts)),
+        ]
+
+    scale = 10000 / args.programs
+    print(f'{args.programs} programs, per 10k programs')
+    print(f'  {"models":<20} {"time, s":>9} {"memory, MB":>11}')
+    for name, (seconds, size) in results:
+        print(f'  {name:<20} {seconds * scale:>9.3f} {size * scale / 2**20:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Benchmark of memory taken by programs kept for making EPG.
+
+Keeps programs of `channels.json` scaled N times, with their details
+and cast, tags and renders them the way a run does, and reports memory
+they take once kept, peak memory of the whole pass and its time:
+
+- models: pydantic programs, each holding its own details and cast
+  (before the program table);
+- table: program tables of channels, details and cast kept once
+  by their ID in stores shared by all channels.
+
+Usage:
+    python benchmarks/bench_programs.py --scales 1 10 50
+    python benchmarks/bench_programs.py --scales 1 10 --hours 168
+"""
+
+import argparse
+import gc
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from typing import List
+
+from bench_epg import ROOT_DIR, copy_tree, make_cast, make_details, program_id
+
+# Modules are imported from a copy of the tree, so importing them
+# never touches caches of the repository
+TREE_DIR = tempfile.TemporaryDirectory(prefix='bench-programs-')
+copy_tree(pathlib.Path(TREE_DIR.name))
+sys.path.insert(0, TREE_DIR.name)
+
+from pydantic import PrivateAttr  # noqa: E402
+
+import models.tvguide  # noqa: E402
+import models.ustvgo  # noqa: E402
+from epg_downloader import (make_xmltv_programme, program_fingerprint,  # noqa: E402
+                            tag_program, xmltv_icon)
+from epg_programs import ProgramStores, ProgramTable  # noqa: E402
+from epg_xmltv import render_element  # noqa: E402
+from ustvgo_iptv import load_dict  # noqa: E402
+
+BASE_URL = 'https://raw.githubusercontent.com/interlark/ustvgo-tvguide/master'
+
+
+class ModelProgram(models.ustvgo.Program):
+    """Program as kept before the table."""
+    tags: List[str] = []
+
+    _details = PrivateAttr(default=None)
+    _cast = PrivateAttr(default=None)
+
+    @property
+    def details(self):
+        return self._details
+
+    @property
+    def cast(self):
+        return self._cast
+
+
+def scaled_channels(scale):
+    """Channels of `channels.json` scaled the way `bench_epg` does."""
+    channels = []
+    for copy_idx in range(scale):
+        for channel in load_dict(ROOT_DIR / 'channels.json'):
+            tvguide_id = channel['tvguide_id']
+            channels.append({
+                **channel,
+                'stream_id': channel['stream_id'] + (f'_{copy_idx}' if copy_idx else ''),
+                'tvguide_id': f'{tvguide_id}{copy_idx:03d}' if tvguide_id and copy_idx else tvguide_id,
+            })
+
+    return channels
+
+
+def schedule(channel, programs_per_channel, start_ts):
+    """Schedule of channel, as downloaded."""
+    if not channel['tvguide_id']:
+        return []
+
+    schedule = []
+    for idx in range(programs_per_channel):
+        pid = program_id(channel['tvguide_id'], idx, programs_per_channel)
+        schedule.append({
+            'id': pid, 'name': f'Program {pid}', 'image': '', 'color': 1,
+            'start_timestamp': start_ts + idx * 1800, 'end_timestamp': start_ts + (idx + 1) * 1800,
+            'description': 'Description', 'day': 'Today', 'start_time': '', 'end_time': '',
+        })
+
+    return schedule
+
+
+def keep_models(channel, programs, payloads):
+    channel['programs'] = [ModelProgram(**program.dict()) for program in programs]
+    for program in channel['programs']:
+        details, cast = payloads(program.id)
+        program._details = models.tvguide.LeanProgramDetails(details)
+        program._cast = models.tvguide.LeanShowsCast(cast)
+
+
+def keep_table(channel, programs, payloads, stores):
+    table = channel['programs'] = ProgramTable(stores)
+    for program in programs:
+        table.append(program.id, program.name, program.start_timestamp,
+                     program.end_timestamp, program_fingerprint(channel, program))
+    for program in table:
+        if program.id not in stores.details:
+            details, cast = payloads(program.id)
+            stores.details[program.id] = models.tvguide.LeanProgramDetails(details)
+            if program.details.mcoId not in stores.casts:
+                program.cast = models.tvguide.LeanShowsCast(cast)
+
+
+def run(layout, channels, programs_per_channel):
+    """Seconds, memory kept and peak memory of the pass, number of programs."""
+    start_ts = int(time.time()) // 1800 * 1800
+    stores = ProgramStores()
+    casts = {}
+
+    def payloads(pid):
+        """Details and cast as loaders cache them."""
+        details = models.tvguide.ProgramDetails(**make_details(pid, posters=2000)).dict()
+        mco_id = details['mcoId']
+        if mco_id not in casts:
+            data = make_cast(mco_id)['components'][0]['data']
+            casts[mco_id] = models.tvguide.ShowsCast(**data).dict()
+        return details, casts[mco_id]
+
+    gc.collect()
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    base, _ = tracemalloc.get_traced_memory()
+    for channel in channels:
+        programs = [models.ustvgo.Program(**program)
+                    for program in schedule(channel, programs_per_channel, start_ts)]
+        if layout == 'models':
+            keep_models(channel, programs, payloads)
+        else:
+            keep_table(channel, programs, payloads, stores)
+    casts.clear()
+    kept, _ = tracemalloc.get_traced_memory()
+
+    def get_icon(icon_name, manifest_name):
+        return xmltv_icon(icon_name, manifest_name, BASE_URL)
+
+    for channel in channels:
+        for program in channel['programs']:
+            tag_program(program, {(program.id, program.start_timestamp): 0b101})
+            render_element(make_xmltv_programme(channel, program, get_icon))
+    seconds = time.perf_counter() - started_at
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    programs = sum(len(channel['programs']) for channel in channels)
+    for channel in channels:
+        del channel['programs']
+    return seconds, kept - base, peak - base, programs
+
+
+def main():
+    parser = argparse.ArgumentParser('bench-programs')
+    parser.add_argument('--scales', metavar='N', type=int, nargs='+', default=[1, 10, 50],
+                        help='Scales of channels.json to keep programs of (default: %(default)s)')
+    parser.add_argument('--hours', metavar='N', type=int, default=24,
+                        help='Hours of programs per channel, half an hour each (default: %(default)s)')
+    parser.add_argument('--layouts', metavar='NAME', nargs='+', choices=['models', 'table'],
+                        default=['models', 'table'],
+                        help='Ways to keep programs (default: %(default)s)')
+    args = parser.parse_args()
+
+    for scale in args.scales:
+        channels = scaled_channels(scale)
+        print(f'\nScale {scale}x: {len(channels)} channels, {args.hours} hours')
+        print(f'  {"layout":<8} {"programs":>9} {"time, s":>9} {"kept, MB":>9} '
+              f'{"peak, MB":>9} {"per program, B":>15}')
+        for layout in args.layouts:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                seconds, kept, peak, programs = run(layout, channels, args.hours * 2)
+            print(f'  {layout:<8} {programs:>9} {seconds:>9.2f} {kept / 2**20:>9.1f} '
+                  f'{peak / 2**20:>9.1f} {kept / max(1, programs):>15.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of converting program details and cast to XMLTV.
+
+Converts details of N programs with `ProgramDetails.to_xmltv` (icons
+of ratings and metascores included) and adds their cast with
+`ShowsCast.add_cast`, reports time per program. Details and cast are
+taken from responses recorded with `--record`, or made up.
+
+Usage:
+    python benchmarks/bench_xmltv.py --programs 5000
+    python benchmarks/bench_xmltv.py --recordings DIR
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+import tempfile
+import time
+import warnings
+from functools import partial
+
+from bench_epg import copy_tree, make_cast, make_details
+
+# Modules are imported from a copy of the tree, so importing them
+# never touches caches of the repository
+TREE_DIR = tempfile.TemporaryDirectory(prefix='bench-xmltv-')
+copy_tree(pathlib.Path(TREE_DIR.name))
+sys.path.insert(0, TREE_DIR.name)
+
+import models.tvguide  # noqa: E402
+import models.xmltv  # noqa: E402
+from epg_downloader import XMLTV_PROGRAM_OPTIONS, xmltv_icon  # noqa: E402
+
+BASE_URL = 'https://raw.githubusercontent.com/interlark/ustvgo-tvguide/master'
+
+
+def recorded_payloads(dirpath):
+    """Details and cast data of recorded responses."""
+    details, casts = [], []
+    for meta_path in sorted(pathlib.Path(dirpath).glob('*.json')):
+        meta = json.loads(meta_path.read_text(encoding='utf-8'))
+        if meta['status'] != 200:
+            continue
+
+        if '/programdetails/' in meta['url']:
+            body = json.loads(meta_path.with_suffix('.body').read_bytes())
+            details.append(body['data']['item'])
+        elif '/shows-cast/' in meta['url']:
+            body = json.loads(meta_path.with_suffix('.body').read_bytes())
+            for component in body.get('components', []):
+                if component.get('meta', {}).get('componentName') == 'tv-object-cast-and-crew':
+                    casts.append(component['data'])
+
+    return details, casts
+
+
+def made_up_payloads(programs):
+    details = [make_details(pid, posters=100) for pid in range(1, programs + 1)]
+    for idx, item in enumerate(details):
+        item['tvRating'] = ['TV-PG', 'TV-14', 'TV-MA', 'PG-13'][idx % 4]
+    casts = [make_cast(item['mcoId'])['components'][0]['data'] for item in details]
+    return details, casts
+
+
+def main():
+    parser = argparse.ArgumentParser('bench-xmltv')
+    parser.add_argument('--programs', metavar='N', type=int, default=5000,
+                        help='Number of made up programs (default: %(default)s)')
+    parser.add_argument('--recordings', metavar='DIR', type=pathlib.Path,
+                        help='Take details and cast of responses recorded into DIR')
+    parser.add_argument('--rounds', metavar='N', type=int, default=3,
+                        help='Report the best of N rounds (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.recordings:
+        details, casts = recorded_payloads(args.recordings)
+    else:
+        details, casts = made_up_payloads(args.programs)
+
+    details = [models.tvguide.ProgramDetails(**item) for item in details]
+    casts = [models.tvguide.ShowsCast(**item) for item in casts] or [None]
+    get_icon = partial(xmltv_icon, base_url=BASE_URL)
+    options = {**XMLTV_PROGRAM_OPTIONS, 'add_tv_rating_icon': True}
+
+    def convert_details():
+        for item in details:
+            item.to_xmltv(get_icon=get_icon, lang='en', **options)
+
+    def add_casts():
+        for idx in range(len(details)):
+            cast = casts[idx % len(casts)]
+            if cast:
+                cast.add_cast(models.xmltv.Programme(clumpidx=None))
+
+    print(f'{len(details)} programs, {len(casts)} casts, best of {args.rounds} rounds')
+    print(f'  {"conversion":<12} {"total, s":>9} {"per program, us":>16}')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for name, func in [('to_xmltv', convert_details), ('add_cast', add_casts)]:
+            timings = []
+            for _ in range(args.rounds):
+                started_at = time.perf_counter()
+                func()
+                timings.append(time.perf_counter() - started_at)
+            best = min(timings)
+            print(f'  {name:<12} {best:>9.3f} {best / len(details) * 10**6:>16.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+from datetime import timedelta
+from typing import NamedTuple, Optional
+
+from furl import furl
+
+# Query parameters which only defeat caching
+CACHE_BUSTERS = ('_',)
+
+
+class Empty:
+    """Known empty result, e.g. program without cast or
+    channel without schedule. Unpickles to the same `EMPTY`."""
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'EMPTY'
+
+    def __reduce__(self):
+        return 'EMPTY'
+
+
+EMPTY = Empty()
+
+# Result of conditional request telling cached result is still valid
+NOT_MODIFIED = object()
+
+
+class CachePolicy(NamedTuple):
+    ttl: int  # Seconds to keep downloaded result
+    negative_ttl: int  # Seconds to keep known empty or failed result
+
+
+class CacheEntry(NamedTuple):
+    value: object
+    fresh_until: float  # Timestamp
+    validators: Optional[dict] = None  # ETag and Last-Modified of response
+
+
+class Download(NamedTuple):
+    result: object
+    validators: Optional[dict] = None
+    failed: bool = False  # Result is the default one of failed download
+
+
+def seconds(**kwargs):
+    return int(timedelta(**kwargs).total_seconds())
+
+
+DEFAULT_CACHE_POLICY = CachePolicy(ttl=seconds(days=2), negative_ttl=seconds(hours=1))
+
+CACHE_POLICIES = {
+    # Schedules change, keep them shortly and revalidate (grid windows with tags too)
+    'schedule': CachePolicy(ttl=seconds(minutes=10), negative_ttl=seconds(minutes=5)),
+    'details': CachePolicy(ttl=seconds(days=2), negative_ttl=seconds(hours=6)),
+    'cast': CachePolicy(ttl=seconds(days=2), negative_ttl=seconds(days=1)),
+    # Resized posters are kept by the poster store, only failures are cached
+    'image': CachePolicy(ttl=0, negative_ttl=seconds(hours=1)),
+}
+
+# Keep stale entries having validators to revalidate them later
+STALE_RETENTION = seconds(days=7)
+
+
+def normalize_url(url):
+    """Cache key of URL: without cache busters and with sorted query."""
+    url = furl(url).remove(args=CACHE_BUSTERS)
+    url.args = sorted(url.args.allitems())
+    return url.url
+
+
+def response_validators(response):
+    """Validators of HTTP response to make conditional requests with."""
+    validators = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+    return {k: v for k, v in validators.items() if v} or None
+
+
+def conditional_headers(validators):
+    """Headers of conditional HTTP request."""
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    return headers
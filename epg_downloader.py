@@ -3,40 +3,89 @@
 import argparse
 import asyncio
 import atexit
+import collections
+import contextlib
 import functools
-import gzip
+import inspect
 import io
 import json
+import os
 import pathlib
-import shutil
+import sqlite3
+import sys
 import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
 from functools import lru_cache, partial
+from typing import NamedTuple
 
 import aiohttp
-import lxml.etree as ET
 import xmltv.models
 from diskcache import Cache
 from furl import furl
+from lxml.etree import XMLSyntaxError
 from PIL import Image
 from pydantic import ValidationError
 from tqdm import tqdm
-from xsdata.formats.dataclass.serializers import XmlSerializer
-from xsdata.formats.dataclass.serializers.config import SerializerConfig
 
 import models.tvguide
 import models.ustvgo
 import models.xmltv
-from ustvgo_iptv import (USER_AGENT, USTVGO_HEADERS, gather_with_concurrency,
-                         load_dict, logger, root_dir)
+from epg_cache import (CACHE_POLICIES, DEFAULT_CACHE_POLICY, EMPTY,
+                       NOT_MODIFIED, STALE_RETENTION, CacheEntry, Download,
+                       conditional_headers, normalize_url, response_validators)
+from epg_http import (HOST_LIMITERS, HOST_POLICIES, THROTTLE_STATUSES,
+                      backoff_delay, host_limiter, host_policy, parse_retry_after)
+from epg_metrics import (METRICS, count, observe_latency, profiling,
+                         save_metrics, stage, staged)
+from epg_posters import PosterStore
+from epg_programs import ProgramStores, ProgramTable
+from epg_replay import record_response, replay_url, replaying, start_recording
+from epg_server import EpgServer
+from epg_state import RunState, fingerprint
+from epg_store import NAMESPACES, CompactStore, StoreCache, count_hit
+from epg_xmltv import XmltvWriter, merge_documents, render_element
+from ustvgo_iptv import (USER_AGENT, USTVGO_HEADERS, load_dict, logger,
+                         root_dir, run_pipeline)
 
 # Usage:
 # ./epg-downloader.py ustvgo.xml --create-archive
+# ./epg-downloader.py -o ustvgo.for-dark-bg.xml -o ustvgo.for-light-bg.xml:light --create-archive
+# ./epg-downloader.py -o ustvgo.xml --serve --serve-port 8080 --refresh-interval 30
+# ./epg-downloader.py cache prune --older-than 72
+# ./epg-downloader.py shard1.xml --shard 1/2 & ./epg-downloader.py shard2.xml --shard 2/2
+# ./epg-downloader.py merge ustvgo.xml shard1.xml shard2.xml --create-archive
 
 
 VERSION = '0.1.1'
-DISK_CACHE = Cache(root_dir() / 'cache', size_limit=2**32)  # 2**32 bytes == 4 GB
-DISK_CACHE_EXPIRE = int(timedelta(days=2).total_seconds())  # 2 days cache expire
+# Caches are opened by `open_caches`, by runs and `cache` command only
+DISK_CACHE = None
+COMPACT_STORE = None
+STORE_CACHE = None
+DNS_CACHE_TTL = int(timedelta(minutes=10).total_seconds())
+KEEPALIVE_TIMEOUT = 60
+
+# Futures of calls currently in flight, by key
+IN_FLIGHT = {}
+
+# Share of deadline kept for making EPG out of downloaded programs
+DEADLINE_RESERVE = 0.1
+
+# Endpoints kept in the compact store, by namespace of the store
+STORE_NAMESPACES = {
+    'details': 'details',
+    'cast': 'cast',
+}
+
+# Budget of every cache maintenance: seconds and expired entries to remove
+CACHE_MAINTENANCE_SECONDS = 2
+CACHE_MAINTENANCE_ENTRIES = 10000
+CACHE_MAINTENANCE_CHUNK = 500
+
+# Programs grid of tvguide.com, Eastern Time Zone
+GRID_PROVIDER_ID = '9100001138'
 
 XMLTV_PROGRAM_OPTIONS = {
     # Whether to expand genres
@@ -47,33 +96,282 @@ XMLTV_PROGRAM_OPTIONS = {
 }
 
 
-@atexit.register
+def open_caches():
+    """Open caches in `cache` directory, once, they are closed on exit."""
+    global DISK_CACHE, COMPACT_STORE, STORE_CACHE
+    if STORE_CACHE is not None:
+        return
+
+    DISK_CACHE = Cache(root_dir() / 'cache', size_limit=2**32)  # 2**32 bytes == 4 GB
+    COMPACT_STORE = CompactStore(root_dir() / 'cache' / 'store.db')
+    STORE_CACHE = StoreCache(COMPACT_STORE, namespaces={'details', 'cast'})
+    atexit.register(close_cache)
+
+
 def close_cache():
-    """Cleanup cache and close."""
-    DISK_CACHE.expire()
+    """Store buffered entries and close caches.
+
+    Expired entries are removed during runs, by `maintain_cache`,
+    and by `DISK_CACHE` itself on writes, heavy cleanup is up
+    to `cache` command.
+    """
     DISK_CACHE.close()
+    STORE_CACHE.flush()
+    COMPACT_STORE.close()
+
+
+async def single_flight(key, func, *args, **kwargs):
+    """Await `func` once for all concurrent callers with the same key.
+
+    Callers share the result, as they share results served from cache:
+    downloads are read into new models, never modified.
+    """
+    future = IN_FLIGHT.get(key)
+    if future is not None:
+        count('requests_coalesced')
+        return await asyncio.shield(future)
+
+    future = asyncio.ensure_future(func(*args, **kwargs))
+    IN_FLIGHT[key] = future
+    future.add_done_callback(lambda _: IN_FLIGHT.pop(key, None))
+    return await asyncio.shield(future)
+
+
+def download_single_flight(func):
+    """Single-flight wrapper for `download_with_retries`."""
+    @functools.wraps(func)
+    async def inner(session, url, *args, **kwargs):
+        key = kwargs.get('cache_key') or normalize_url(url)
+        return await single_flight((kwargs.get('endpoint'), key),
+                                   func, session, url, *args, **kwargs)
+
+    return inner
+
+
+@staged('cache_gc')
+async def maintain_cache(seconds=CACHE_MAINTENANCE_SECONDS, entries=CACHE_MAINTENANCE_ENTRIES):
+    """Remove expired entries of the compact store in a thread, chunk
+    by chunk, until there are none or the budget is spent."""
+    loop = asyncio.get_running_loop()
+    started_at = time.perf_counter()
+    removed = 0
+    try:
+        while removed < entries and time.perf_counter() - started_at < seconds:
+            chunk = min(CACHE_MAINTENANCE_CHUNK, entries - removed)
+            chunk_removed = await loop.run_in_executor(STORE_CACHE.executor,
+                                                       COMPACT_STORE.expire, chunk)
+            removed += chunk_removed
+            if chunk_removed < chunk:
+                break
+    except sqlite3.Error as e:
+        logger.warning('Cache maintenance failed: %s', e)
+    finally:
+        count('cache_expired', removed)
+
+
+async def cache_get(endpoint, key):
+    """Get cache entry of endpoint's result."""
+    namespace = STORE_NAMESPACES.get(endpoint)
+    if namespace:
+        return await STORE_CACHE.get(namespace, key)
+
+    return count_hit(DISK_CACHE.get(key=key), 'disk')
+
+
+def cache_set(endpoint, key, entry, expire):
+    """Cache entry of endpoint's result for `expire` seconds."""
+    namespace = STORE_NAMESPACES.get(endpoint)
+    if namespace:
+        STORE_CACHE.set(namespace, key, entry, expire)
+    else:
+        DISK_CACHE.set(key=key, value=entry, expire=expire)
 
 
 def download_cached_by_url(func):
-    """Cached wrapper for `download_with_retries`."""
+    """Cached wrapper for `download_with_retries`.
+
+    Results are cached by normalized URL, unless `cache_key` is given,
+    for as long as cache policy of the `endpoint` says. Empty and failed
+    results are cached as well, they come back as `EMPTY`. Stale results
+    are revalidated with conditional request and reused if not modified.
+    Results of endpoints in `STORE_NAMESPACES` go to the compact store,
+    they must be JSON serializable. Results of endpoints with no TTL
+    are not cached, unless they're empty or failed.
+    If revalidation of stale result fails, the stale result is reused
+    and kept for as long as failed results are.
+    """
     @functools.wraps(func)
-    async def inner(url, *args, **kwargs):
-        result = DISK_CACHE.get(key=url)
-        if not result:
-            result = await func(url, *args, **kwargs)
-            if result:
-                DISK_CACHE.set(key=url, value=result, expire=DISK_CACHE_EXPIRE)
+    async def inner(session, url, *args, cache_key=None, endpoint=None, **kwargs):
+        key = cache_key or normalize_url(url)
+        entry = await cache_get(endpoint, key)
+        if not isinstance(entry, CacheEntry):
+            entry = None  # Missing or stored by older version
+
+        if entry and entry.fresh_until > time.time():
+            count('cache_negative_hits' if entry.value is EMPTY else 'cache_hits')
+            return entry.value
+
+        download = await func(session, url, *args,
+                              validators=entry.validators if entry else None, **kwargs)
+        policy = CACHE_POLICIES.get(endpoint, DEFAULT_CACHE_POLICY)
+        if download.failed and entry and entry.value is not EMPTY:
+            # Don't clobber known good result, try again later
+            count('cache_stale_reused')
+            cache_set(endpoint, key, entry._replace(fresh_until=time.time() + policy.negative_ttl),
+                      expire=policy.negative_ttl + (STALE_RETENTION if entry.validators else 0))
+            return entry.value
+
+        if download.result is NOT_MODIFIED:
+            count('cache_not_modified')
+            result, validators = entry.value, download.validators or entry.validators
+        else:
+            count('cache_misses')
+            result, validators = download.result, download.validators
+
+        ttl = policy.ttl if result else policy.negative_ttl
+        result = result or EMPTY
+        if ttl:
+            cache_set(endpoint, key, CacheEntry(result, time.time() + ttl, validators),
+                      expire=ttl + STALE_RETENTION if validators else ttl)
 
         return result
 
     return inner
 
 
+def create_session():
+    """Create HTTP session shared by all downloads of the run.
+
+    Connections are kept alive and pooled per host, DNS lookups are cached.
+    Number of connections per host is bound by host limiters.
+    """
+    async def on_connection_create_end(session, context, params):
+        count('connections_opened')
+
+    async def on_connection_reuseconn(session, context, params):
+        count('connections_reused')
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+
+    connector = aiohttp.TCPConnector(
+        limit=0, ttl_dns_cache=DNS_CACHE_TTL, keepalive_timeout=KEEPALIVE_TIMEOUT
+    )
+    return aiohttp.ClientSession(connector=connector, trace_configs=[trace_config],
+                                 raise_for_status=True)
+
+
+def log_run_summary():
+    """Log counters collected during the run."""
+    for name, stage_metrics in METRICS.stages.items():
+        if not stage_metrics.calls:
+            continue  # Counters only
+
+        counters = stage_metrics.counters
+        logger.info('Stage %s: %.2f s, %d requests, %d retries, %.1f KB downloaded',
+                    name, stage_metrics.wall, counters['requests'], counters['retries'],
+                    counters['bytes_downloaded'] / 1024)
+    logger.info('HTTP connections: %d opened, %d reused',
+                METRICS.total('connections_opened'), METRICS.total('connections_reused'))
+    logger.info('Requests saved by coalescing: %d', METRICS.total('requests_coalesced'))
+    logger.info('Cache: %d hits (%d memory, %d disk), %d known empty, %d not modified, '
+                '%d stale reused, %d misses',
+                METRICS.total('cache_hits'), METRICS.total('cache_memory_hits'),
+                METRICS.total('cache_disk_hits'), METRICS.total('cache_negative_hits'),
+                METRICS.total('cache_not_modified'), METRICS.total('cache_stale_reused'),
+                METRICS.total('cache_misses'))
+    logger.info('Cache lookups: %d prefetched in %.3f s, %.3f s one by one, %.3f s writing back',
+                METRICS.total('cache_prefetched'), METRICS.total('cache_prefetch_seconds'),
+                METRICS.total('cache_lookup_seconds'), METRICS.total('cache_flush_seconds'))
+    for limiter in HOST_LIMITERS.values():
+        logger.info('Host %s: %d requests, %.1f req/s, %d throttled, concurrency %d/%d',
+                    limiter.host, limiter.requests, limiter.throughput, limiter.throttles,
+                    limiter.limit, limiter.policy.max_concurrency)
+    logger.info('Programs: %d reused, %d rebuilt',
+                METRICS.total('programs_reused'), METRICS.total('programs_rebuilt'))
+    logger.info('Posters: %d reused, %d encoded, %d removed', METRICS.total('posters_reused'),
+                METRICS.total('posters_encoded'), METRICS.total('posters_removed'))
+    logger.info('Cache maintenance: %d expired entries removed', METRICS.total('cache_expired'))
+    log_cache_stats()
+
+
+def log_cache_stats():
+    """Log number of entries and size of caches."""
+    for namespace, stats in COMPACT_STORE.stats().items():
+        logger.info('Store %s: %d entries, %.1f KB', namespace, stats['entries'],
+                    stats['bytes'] / 1024)
+    logger.info('Store file: %.1f KB', COMPACT_STORE.file_size() / 1024)
+    logger.info('Responses (schedules, tags, failed images): %d entries, %.1f KB',
+                len(DISK_CACHE), DISK_CACHE.volume() / 1024)
+
+
+def log_degraded(degraded, limit=20):
+    """Log programs and channels without schedule degraded by deadline."""
+    if not degraded:
+        return
+
+    channels = sum(program is None for _, program in degraded)
+    count('programs_degraded', len(degraded) - channels)
+    count('channels_degraded', channels)
+    logger.warning('Deadline: %d programs degraded, %d channels without schedule',
+                   len(degraded) - channels, channels)
+    for channel, program in degraded[:limit]:
+        if program is None:
+            logger.warning('  %s: missing schedule', channel['stream_id'])
+            continue
+
+        logger.warning('  %s: %s at %s, missing %s', channel['stream_id'], program.name,
+                       datetime.fromtimestamp(program.start_timestamp, tz=timezone.utc),
+                       ', '.join(program.degraded))
+    if len(degraded) > limit:
+        logger.warning('  ... and %d more', len(degraded) - limit)
+
+
+def degraded_metrics(degraded):
+    """Metrics of programs and channels without schedule degraded by deadline."""
+    return [
+        {'channel': channel['stream_id'], 'program_id': program.id, 'name': program.name,
+         'start_timestamp': program.start_timestamp, 'missing': program.degraded}
+        if program else
+        {'channel': channel['stream_id'], 'program_id': None, 'name': None,
+         'start_timestamp': None, 'missing': ['schedule']}
+        for channel, program in degraded
+    ]
+
+
+def host_metrics():
+    """Metrics of host limiters."""
+    return {
+        limiter.host: {
+            'requests': limiter.requests,
+            'requests_per_second': round(limiter.throughput, 3),
+            'throttles': limiter.throttles,
+            'concurrency': int(limiter.limit),
+        }
+        for limiter in HOST_LIMITERS.values()
+    }
+
+
+@download_single_flight
 @download_cached_by_url
-async def download_with_retries(url, headers=None, timeout=1, timeout_increment=1,
+async def download_with_retries(session, url, headers=None, timeout=1, timeout_increment=1,
                                 timeout_max=10, retries_max=10, method='json',
-                                extra_exceptions=None, loader=None, ret_default=None):
-    """Download URL with retries."""
+                                extra_exceptions=None, loader=None, ret_default=None,
+                                validators=None):
+    """Download URL with retries.
+
+    Requests are limited per host, retries of network errors are delayed
+    with exponential backoff and jitter or as long as throttling host asks to,
+    responses failing to decode are retried at once.
+    `loader` converts downloaded response, it may return an awaitable,
+    its errors fail the download right away.
+    Request is conditional if `validators` of cached response are given.
+    Returns loaded result (`NOT_MODIFIED` if cached one is still valid)
+    along with validators of the response.
+    Requests, retries, downloaded bytes and time spent loading
+    are counted in the current stage, latency - per host.
+    """
     exceptions = [asyncio.TimeoutError, aiohttp.ClientConnectionError,
                   aiohttp.ClientResponseError, aiohttp.ServerDisconnectedError]
     if method == 'json':
@@ -82,63 +380,378 @@ async def download_with_retries(url, headers=None, timeout=1, timeout_increment=
         exceptions.extend(extra_exceptions)
 
     loader = loader if loader else lambda x: x
+    headers = {**(headers or {}), **conditional_headers(validators)}
+    limiter = host_limiter(url)
     retry = 1
     while True:
+        retry_after = None
+        is_loading = False
         try:
-            async with aiohttp.ClientSession(headers=headers, raise_for_status=True) as session:
-                async with session.get(url, timeout=timeout) as response:
-                    return loader(await getattr(response, method)())
+            client_timeout = aiohttp.ClientTimeout(total=timeout)
+            async with limiter:
+                count('requests')
+                started_at = time.perf_counter()
+                try:
+                    async with session.get(replay_url(url), headers=headers,
+                                           timeout=client_timeout) as response:
+                        limiter.on_success()
+                        if response.status == HTTPStatus.NOT_MODIFIED:
+                            return Download(NOT_MODIFIED, response_validators(response))
+
+                        count('bytes_downloaded', len(await response.read()))
+                        data = await getattr(response, method)()
+                        validators = response_validators(response)
+                        await record_response(url, response)
+                finally:
+                    observe_latency(limiter.host, time.perf_counter() - started_at)
+
+            # Loading (validation, resize) is timed apart from the network
+            is_loading = True
+            started_at = time.perf_counter()
+            try:
+                result = loader(data)
+                if inspect.isawaitable(result):
+                    result = await result
+            finally:
+                count('load_seconds', time.perf_counter() - started_at)
+
+            return Download(result, validators)
         except Exception as e:
             is_exc_valid = any([isinstance(e, exc) for exc in exceptions])
             if not is_exc_valid:
                 raise
+            if is_loading:
+                # Loader fails the same way on every try, don't hold on to it
+                logger.warning('Failed to load URL %s: %r', url, e)
+                count('failures')
+                return Download(ret_default, failed=True)
+            if isinstance(e, aiohttp.ClientResponseError) and e.status in THROTTLE_STATUSES:
+                retry_after = parse_retry_after(e.headers and e.headers.get('Retry-After'))
+                limiter.on_throttle(retry_after)
+            elif isinstance(e, asyncio.TimeoutError):
+                limiter.on_throttle()
+
             timeout = min(timeout + timeout_increment, timeout_max)
-            if retry > retries_max:
+            if retry > retries_max or is_client_error(e):
                 logger.warning('Failed to download URL %s', url)
-                return ret_default
+                count('failures')
+                return Download(ret_default, failed=True)
+            count('retries')
+            if not isinstance(e, json.JSONDecodeError):
+                # Broken body is likely cut, only network errors are backed off
+                await asyncio.sleep(backoff_delay(retry, retry_after))
             retry += 1
 
 
-async def download_programs(channel):
+def is_client_error(e):
+    """Whether exception is client error response, not worth retrying."""
+    return isinstance(e, aiohttp.ClientResponseError) and 400 <= e.status < 500 \
+        and e.status not in (HTTPStatus.REQUEST_TIMEOUT, HTTPStatus.TOO_MANY_REQUESTS)
+
+
+@staged('schedule')
+async def download_programs(session, channel):
     """Download list of upcoming programs from USTVGO endpoint."""
     if not channel['tvguide_id']:
-        channel['programs'] = []
-        return
+        return []
 
-    url = 'https://ustvgo.tv/tvguide/JSON2/%s.json?_=%d' \
-        % (channel['tvguide_id'], time.time())  # NOTE: 100% cache miss
+    url = 'https://ustvgo.tv/tvguide/JSON2/%s.json' % channel['tvguide_id']
 
     def loader(response):
         programs = sum(response.get('items', {}).values(), [])
         return [models.ustvgo.Program(**program) for program in programs]
 
-    channel['programs'] = await download_with_retries(
-        url, USTVGO_HEADERS, loader=loader, ret_default=[],
+    # Channels sharing the same tvguide_id share the download as well
+    programs = await single_flight(
+        ('channel', channel['tvguide_id']), download_with_retries,
+        session, url, USTVGO_HEADERS, loader=loader, endpoint='schedule',
         extra_exceptions=[ValidationError, AttributeError],
     )
+    return programs or []
 
 
-async def download_program_detail(program):
+class Grid(NamedTuple):
+    schedules: dict  # Airings by channel source ID
+    airing_attrs: dict  # By program ID and start timestamp
+
+
+def grid_windows(horizon, window):
+    """Start timestamps and durations in minutes of grid windows
+    covering `horizon` hours by `window` hours.
+
+    Windows are aligned to half an hour, so they are cached between runs.
+    """
+    start_ts = int(time.time()) - 30 * 60
+    start_ts -= start_ts % (30 * 60)
+    return [(window_ts, window * 60)
+            for window_ts in range(start_ts, start_ts + horizon * 3600, window * 3600)]
+
+
+async def download_grid(session, horizon, window):
+    """Download schedules and airing attributes of all channels
+    from tvguide.com grid, windows in parallel."""
+    headers = {**USTVGO_HEADERS, 'Referer': 'https://www.tvguide.com/'}
+
+    def loader(response):
+        airings = collections.defaultdict(list)
+        for item in response['data']['items']:
+            source_id = str((item.get('channel') or {}).get('sourceId') or '')
+            airings[source_id] += [
+                (x['programId'], x.get('title') or '', x['startTime'], x.get('endTime'),
+                 x.get('airingAttrib') or 0)
+                for x in item['programSchedules']
+            ]
+        return dict(airings)
+
+    windows = await asyncio.gather(*[
+        download_with_retries(
+            session, ('https://cmg-prod.apigee.net/v1/xapi/tvschedules'
+                      f'/tvguide/{GRID_PROVIDER_ID}/web?start={start_ts}&duration={duration_mins}'),
+            headers, loader=loader, endpoint='schedule', extra_exceptions=[KeyError, TypeError]
+        )
+        for start_ts, duration_mins in grid_windows(horizon, window)
+    ])
+
+    # Programs airing across windows come in both
+    schedules, airing_attrs = collections.defaultdict(dict), {}
+    for airings in filter(None, windows):
+        for source_id, channel_airings in airings.items():
+            for program_id, title, start_ts, end_ts, attrs in channel_airings:
+                if not program_id:
+                    continue
+                if attrs:
+                    airing_attrs[(program_id, start_ts)] = attrs
+                if source_id and end_ts:
+                    schedules[source_id][(program_id, start_ts)] = (program_id, title,
+                                                                    start_ts, end_ts)
+
+    if not all(windows):
+        # Schedules with gaps are worse than per channel ones
+        logger.warning('Programs grid is incomplete, its schedules are not used')
+        schedules.clear()
+
+    return Grid({source_id: sorted(airings.values(), key=lambda airing: airing[2])
+                 for source_id, airings in schedules.items()}, airing_attrs)
+
+
+def grid_program(airing):
+    """Make program out of grid airing."""
+    program_id, title, start_ts, end_ts = airing
+    return models.ustvgo.Program(id=program_id, name=title, image='', start_timestamp=start_ts,
+                                 end_timestamp=end_ts, color=0, description='', day='',
+                                 start_time='', end_time='')
+
+
+def shard_channels(channels, shard):
+    """Channels of the k-th shard of n, `shard` is `(k, n)`.
+
+    Channels are split by tvguide_id, so channels sharing schedule
+    go to the same shard, the same one run after run.
+    """
+    k, n = shard
+    return [channel for channel in channels
+            if zlib.crc32((channel['tvguide_id'] or channel['stream_id']).encode('utf-8')) % n == k - 1]
+
+
+async def iter_channels_programs(session, channels, reuse=None, grid=None):
+    """Yield programs of every channel as soon as its schedule is downloaded.
+
+    Schedules are taken from awaited `grid`, if given, channels it doesn't
+    cover are downloaded one by one. Programs of every channel are kept
+    in its `ProgramTable`, their downloads - in stores shared by all channels.
+    Programs `reuse` tells are rendered already are not yielded,
+    cached downloads of the rest are prefetched.
+    """
+    stores = ProgramStores()
+
+    async def download(channel):
+        airings = (await grid).schedules.get(channel['tvguide_id']) if grid else None
+        if airings:
+            programs = [grid_program(airing) for airing in airings]
+            count('grid_channels')
+        else:
+            programs = await download_programs(session, channel)
+
+        table = ProgramTable(stores)
+        for program in programs:
+            table.append(program.id, program.name, program.start_timestamp,
+                         program.end_timestamp, program_fingerprint(channel, program))
+        channel['programs'] = table
+        return channel
+
+    tasks = [asyncio.ensure_future(download(channel)) for channel in channels]
+    try:
+        for task in asyncio.as_completed(tasks):
+            channel = await task
+            programs = [program for program in channel['programs']
+                        if not (reuse and reuse(channel, program))]
+            prefetch_programs(programs)
+            for program in programs:
+                yield program
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def prefetch_programs(programs):
+    """Load cached details of programs in bulk, then cast of them."""
+    def prefetch_cast(future):
+        if not future.cancelled() and not future.exception():
+            STORE_CACHE.prefetch('cast', [
+                str(entry.value['mcoId']) for entry in future.result().values()
+                if entry.value and entry.value['mcoId']
+            ])
+
+    future = STORE_CACHE.prefetch('details', [str(program.id) for program in programs])
+    if future:
+        future.add_done_callback(prefetch_cast)
+
+
+async def iter_items(items):
+    for item in items:
+        yield item
+
+
+def time_left(deadline_at):
+    """Seconds left till `deadline_at`, None if there is no deadline."""
+    return max(0, deadline_at - time.monotonic()) if deadline_at else None
+
+
+def cancel_in_flight():
+    """Cancel calls in flight, nobody waits for them anymore."""
+    for future in list(IN_FLIGHT.values()):
+        future.cancel()
+
+
+async def download_by_priority(session, channels, airing_attrs, reuse, stages, parallel,
+                               deadline_at, grid=None):
+    """Download programs stage by stage until `deadline_at` (monotonic time).
+
+    Schedules go first, then every stage goes through programs airing
+    soonest first. Once time is out, outstanding downloads, tags and grid
+    are cancelled. Returns channels left without schedule.
+    """
+    programs = []
+
+    async def download_schedules():
+        async for program in iter_channels_programs(session, channels, reuse, grid):
+            programs.append(program)
+
+    async def run_stage(name, stage_func):
+        await run_pipeline(iter_items(programs), stage_func, concurrency=parallel,
+                           progress_title=f'Download {name}')
+
+    phases = [('schedule', download_schedules)]
+    phases += [(name, partial(run_stage, name, stage_func)) for name, stage_func in stages]
+    for name, phase in phases:
+        try:
+            await asyncio.wait_for(phase(), timeout=time_left(deadline_at))
+        except asyncio.TimeoutError:
+            logger.warning('Deadline reached during %s stage', name)
+            cancel_in_flight()
+            for future in filter(None, [airing_attrs, grid]):
+                future.cancel()
+            break
+
+        await STORE_CACHE.write_back()
+        programs.sort(key=lambda program: program.start_timestamp)
+
+    unscheduled = [channel for channel in channels if 'programs' not in channel]
+    for channel in unscheduled:
+        # Schedule didn't come in time, the channel goes without programs
+        channel['programs'] = []
+
+    return unscheduled
+
+
+def mark_degraded(channels, unscheduled=()):
+    """Mark programs to be rendered with stages they miss downloads of.
+
+    Returns them along with their channels, channels left without
+    schedule come with None.
+    """
+    degraded = [(channel, None) for channel in unscheduled]
+    for channel in channels:
+        for program in channel['programs']:
+            if program.fragment:
+                continue
+
+            # Downloads of other airings of the program count as well
+            program.degraded = program.missing
+            if program.degraded:
+                degraded.append((channel, program))
+
+    return degraded
+
+
+def program_fingerprint(channel, program):
+    """Fingerprint of program source, downloads for the program depend on.
+
+    Tags are not known by then, they are compared apart.
+    """
+    return fingerprint([program.dict(), channel['language']])
+
+
+def reuse_program(run_state, poster_store, channel, program):
+    """Take program rendered by the last run, if its source and posters are the same."""
+    key = RunState.make_key(channel['stream_id'], program.id, program.start_timestamp)
+    entry = run_state.get(key, program.fingerprint)
+    if not entry or not all(poster_store.get(poster) for poster in entry['posters']):
+        return False
+
+    # Text of the fragment is shared with the run state, it's encoded on writing
+    program.fragment = entry['fragment']
+    program.fragment_tags = entry['tags']
+    run_state.put(key, program.fingerprint, entry['fragment'], program.end_timestamp,
+                  entry['posters'], entry['tags'], rendered_at=entry['rendered_at'])
+    return True
+
+
+def remember_program(run_state, channel, program, fragment):
+    """Keep rendered program for the next run, unless its enrichment is missing."""
+    details = program.details
+    if not details or program.degraded \
+            or any(image.bucketType != 'local' for image in details.images):
+        return  # Incomplete, better rebuild it next time
+
+    key = RunState.make_key(channel['stream_id'], program.id, program.start_timestamp)
+    run_state.put(key, program.fingerprint, fragment.decode('utf-8'),
+                  program.end_timestamp, program.posters or [], program.tags)
+
+
+@staged('details')
+async def download_program_detail(session, program):
     """Download program details from tvguide.com"""
+    if program.id in program.stores.details:
+        return  # Downloaded for the same program on another channel or airing
+
     headers = {'Referer': 'https://google.com', 'User-Agent': USER_AGENT}
     url = ('https://cmg-prod.apigee.net/v1/xapi/tvschedules/'
            'tvguide/programdetails/%d/web' % program.id)
 
     def loader(response):
-        return models.tvguide.ProgramDetails(**response['data']['item'])
+        # Validated and trimmed to fields of the model
+        return models.tvguide.ProgramDetails(**response['data']['item']).dict()
 
-    program._details = await download_with_retries(
-        url, headers, loader=loader,
-        extra_exceptions=[ValidationError, KeyError]
+    details = await download_with_retries(
+        session, url, headers, loader=loader, endpoint='details',
+        cache_key=str(program.id), extra_exceptions=[ValidationError, KeyError]
+    )
+    # Loader validated details, downloaded or cached, once. Programs downloading
+    # them at the same time keep the first ones, images of which are stored
+    program.stores.details.setdefault(
+        program.id, models.tvguide.LeanProgramDetails(details) if details else None
     )
 
 
-async def download_program_cast(program):
+@staged('cast')
+async def download_program_cast(session, program):
     """Download program Cast & Crew."""
-    if program._details and program._details.mcoId:
+    details = program.details
+    if details and details.mcoId and details.mcoId not in program.stores.casts:
         headers = {'Referer': 'https://google.com', 'User-Agent': USER_AGENT}
         url = ('https://cmg-prod.apigee.net/v1/xapi/composer/tvguide/pages/'
-               'shows-cast/%d/web?contentOnly=true' % program._details.mcoId)
+               'shows-cast/%d/web?contentOnly=true' % details.mcoId)
 
         def loader(response):
             # Find "Cast & Crew" component
@@ -147,86 +760,131 @@ async def download_program_cast(program):
                 if meta.get('componentName') == 'tv-object-cast-and-crew':
                     cast_data = component.get('data', {})
                     if cast_data:
-                        return models.tvguide.ShowsCast(**cast_data)
+                        return models.tvguide.ShowsCast(**cast_data).dict()
 
-            # Component not found, return dummy cast
-            return models.tvguide.ShowsCast(id='0', items=[])
+            # Component not found, no cast
+            return EMPTY
 
-        program._cast = await download_with_retries(
-            url, headers, loader=loader,
+        cast = await download_with_retries(
+            session, url, headers, loader=loader, endpoint='cast',
+            cache_key=str(details.mcoId),
             extra_exceptions=[ValidationError, KeyError, AttributeError]
         )
+        program.cast = models.tvguide.LeanShowsCast(cast) if cast else None
+
+
+def resize_image(data, images_size, images_quality):
+    """Resize image in a single decode pass.
 
+    Runs in a worker process, returns image bytes, width and height.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail((images_size, images_size))
+        bytesio = io.BytesIO()
+        img.save(bytesio, format=img.format, quality=images_quality)
+        return bytesio.getvalue(), img.width, img.height
 
-async def download_program_images(program, images_size, images_quality, base_url):
-    """Download and resize program images."""
-    if not program._details:
-        return  # Nothing to download, bail
+
+@staged('image')
+async def download_program_images(session, program, executor, poster_store,
+                                  images_size, images_quality, base_url):
+    """Download and resize program images.
+
+    Images of details shared by programs are stored once, by the first of them.
+    """
+    if not program.details or program.posters is not None:
+        return  # Nothing to download or stored already, bail
 
     def loader(response):
-        """Image resize in loader for
-        reducing disk cache size."""
-        with Image.open(io.BytesIO(response)) as img:
-            img.thumbnail((images_size, images_size))
-            bytesio = io.BytesIO()
-            img.save(bytesio, format=img.format, quality=images_quality)
-            return bytesio.getbuffer().tobytes()
-
-    for image in program._details.images:
-        try:
-            # Download image
-            img_bytes = await download_with_retries(
-                image.url, method='read', loader=loader,
-                timeout=15, timeout_max=120, timeout_increment=10
-            )
+        """Image resize in loader, off the event loop."""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(executor, resize_image, response, images_size, images_quality)
+
+    async def store_poster(image, key):
+        """Download, resize and store poster unless it's stored already."""
+        entry = poster_store.get(key)
+        if entry:
+            count('posters_reused')
+            return entry
+
+        resized = await download_with_retries(
+            session, image.url, method='read', loader=loader, endpoint='image',
+            cache_key=key, timeout=15, timeout_max=120, timeout_increment=10
+        )
+        if not resized:
+            return None
+
+        img_bytes, img_width, img_height = resized
+        count('posters_encoded')
+        count('bytes_written', len(img_bytes))
+        suffix = pathlib.PurePosixPath(image.bucketPath).suffix
+        return poster_store.put(key, img_bytes, img_width, img_height, suffix)
 
-            # Path for img
-            img_path = root_dir() / 'images' / 'posters' / image.bucketPath.lstrip('/')
-            img_path.parent.mkdir(parents=True, exist_ok=True)
+    program.posters = posters = []
+    for image in program.details.images:
+        try:
+            key = poster_store.make_key(image.bucketPath, images_size, images_quality)
+            entry = await single_flight(('poster', key), store_poster, image, key)
+            if not entry:
+                continue
 
-            # Save preloaded image
-            iobytes = io.BytesIO(img_bytes)
-            img_path.write_bytes(iobytes.getbuffer())
+            posters.append(key)
 
             # Update image parameters
-            with Image.open(iobytes) as img:
-                image.width = img.width
-                image.height = img.height
-                image.bucketPath = (furl(base_url) / 'images/posters' / image.bucketPath).url
-                image.bucketType = 'local'
+            image.width = entry['width']
+            image.height = entry['height']
+            image.bucketPath = (furl(base_url) / 'images/posters' / entry['path']).url
+            image.bucketType = 'local'
         except Exception as e:
             logger.warn(('Something bad happened during '
                          'working with image: %s (URL: %s)', e, image.url))
 
 
-async def download_program_tags(channels):
-    """Download tags for programs."""
-    start_date = datetime.utcnow() - timedelta(minutes=30)
-    start_ts = int(start_date.timestamp())
-    duration_mins = 60 * 12
-    provider_id = '9100001138'  # Eastern Time Zone
-    url = ('https://cmg-prod.apigee.net/v1/xapi/tvschedules'
-           f'/tvguide/{provider_id}/web?start={start_ts}&duration={duration_mins}')
-    headers = {**USTVGO_HEADERS, 'Referer': 'https://www.tvguide.com/'}
+@staged('schedule')
+async def download_grid_schedules(session, horizon, window):
+    """Download schedules of all channels from tvguide.com grid."""
+    return await download_grid(session, horizon, window)
 
-    def loader(response):
-        programs = sum([x['programSchedules'] for x in response['data']['items']], [])
-        programs_and_attrs = {(x['programId'], x['startTime']): x['airingAttrib'] for x in programs
-                              if x['airingAttrib'] and x['programId']}
-        return programs_and_attrs
 
-    data = await download_with_retries(url, headers, loader=loader)
-    if data:
-        programs_new = {k for k, v in data.items() if v & 0b100}
-        programs_live = {k for k, v in data.items() if v & 0b1}
+@staged('tags')
+async def download_program_tags(session, horizon, window):
+    """Download airing attributes of programs by program ID and start timestamp,
+    `horizon` hours ahead by `window` hours in parallel."""
+    grid = await download_grid(session, horizon, window)
+    return grid.airing_attrs
 
-        for channel in channels:
-            for program in channel['programs']:
-                if (program.id, program.start_timestamp) in programs_new:
-                    program.tags.append('new')
 
-                if (program.id, program.start_timestamp) in programs_live:
-                    program.tags.append('live')
+def tag_program(program, airing_attrs):
+    """Tag program by its airing attributes."""
+    attrs = airing_attrs.get((program.id, program.start_timestamp), 0)
+    tags = []
+    if attrs & 0b100:
+        tags.append('new')
+
+    if attrs & 0b1:
+        tags.append('live')
+
+    program.tags = tags
+
+
+def tag_programs(channels, airing_attrs):
+    """Tag programs of channels.
+
+    Returns programs rendered by the last run with other tags.
+    """
+    retagged = []
+    for channel in channels:
+        for program in channel.get('programs', []):
+            tag_program(program, airing_attrs)
+            if program.fragment is not None and program.tags != program.fragment_tags:
+                retagged.append(program)
+
+    return retagged
+
+
+async def drop_fragment(program):
+    """Drop program rendered by the last run, to render it anew."""
+    program.fragment = None
 
 
 @lru_cache
@@ -237,162 +895,463 @@ def icon_manifest(manifest_name):
     return manifest
 
 
-def xmltv_icon(icon_name, manifest_name, base_url):
-    """Get XMLTV icon."""
-    manifest = icon_manifest(manifest_name)
-    if icon_name in manifest:
-        icon_info = manifest[icon_name]
-        icon_src = (furl(base_url) / 'images/icons' / icon_info['path']).url
-        return xmltv.models.Icon(src=icon_src, width=icon_info['width'], height=icon_info['height'])
+@lru_cache
+def manifest_icons(manifest_name, base_url):
+    """XMLTV icons of manifest by icon name, resolved once.
 
-    return None
+    Icons are shared by programmes, they are not to be modified.
+    """
+    icons_url = furl(base_url) / 'images/icons'
+    return {
+        icon_name: xmltv.models.Icon(src=(icons_url / icon_info['path']).url,
+                                     width=icon_info['width'], height=icon_info['height'])
+        for icon_name, icon_info in icon_manifest(manifest_name).items()
+    }
 
 
-def make_xmltv(channels, filepath, base_url, icons_for_light_bg):
-    """Make XMLTV document out of stored channels and collected programs."""
-    tv = xmltv.models.Tv(
-        generator_info_name='ustvgo-iptv',
-        generator_info_url='https://github.com/interlark/ustvgo-iptv',
-        date=datetime.now().strftime('%Y%m%d%H%M%S')
-    )
+def xmltv_icon(icon_name, manifest_name, base_url):
+    """Get XMLTV icon."""
+    return manifest_icons(manifest_name, base_url).get(icon_name)
+
 
+def make_xmltv_channels(channels, base_url, icons_for_light_bg):
+    """Make XMLTV channels out of stored channels."""
     get_icon = partial(xmltv_icon, base_url=base_url)
 
-    for channel in tqdm(channels, desc='Make EPG XMLTV'):
-        # Add channels
+    channels_manifest_name = 'channels'
+    if icons_for_light_bg:
+        channels_manifest_name += '-for-light-bg'
+    else:
+        channels_manifest_name += '-for-dark-bg'
+
+    for channel in channels:
         channel_id = channel['stream_id']
         xmltv_channel = xmltv.models.Channel(
             display_name=channel['name'],
             id=channel_id
         )
 
-        channels_manifest_name = 'channels'
-        if icons_for_light_bg:
-            channels_manifest_name += '-for-light-bg'
-        else:
-            channels_manifest_name += '-for-dark-bg'
-
         channel_icon = get_icon(channel_id, channels_manifest_name)
         if channel_icon:
             xmltv_channel.icon.append(channel_icon)
         else:
             logger.warning(f'Failed to get channel icon "{channel_id}"')
 
-        tv.channel.append(xmltv_channel)
-
-        # Add programs
-        for program in channel['programs']:
-            if program._details:
-                # Convert program details to xmltv program
-                xmltv_program = program._details.to_xmltv(
-                    get_icon=get_icon, lang=channel['language'],
-                    **XMLTV_PROGRAM_OPTIONS
-                )
-            else:
-                # Create program without details
-                xmltv_program = models.xmltv.Programme(
-                    title=[xmltv.models.Title(content=[program.name])],
-                    clumpidx=None,
-                )
-
-            # Bind current channel to the program
-            xmltv_program.channel = channel['stream_id']
-
-            # Add tags
-            if 'new' in program.tags:
-                xmltv_program.new = ''
-
-            if 'live' in program.tags:
-                xmltv_program.live = ''
+        yield xmltv_channel
 
-            # Start / End dates
-            start_ts = datetime.fromtimestamp(program.start_timestamp, tz=timezone.utc)
-            end_ts = datetime.fromtimestamp(program.end_timestamp, tz=timezone.utc)
 
-            xmltv_program.start = start_ts.strftime('%Y%m%d%H%M%S %z')
-            xmltv_program.stop = end_ts.strftime('%Y%m%d%H%M%S %z')
-
-            # Add Cast & Crew
-            if program._cast:
-                program._cast.add_cast(xmltv_program)
-
-            tv.programme.append(xmltv_program)
+def make_xmltv_programme(channel, program, get_icon):
+    """Make XMLTV programme out of collected program."""
+    details = program.details
+    if details:
+        # Convert program details to xmltv program
+        xmltv_program = details.to_xmltv(
+            get_icon=get_icon, lang=channel['language'],
+            **XMLTV_PROGRAM_OPTIONS
+        )
+    else:
+        # Create program without details
+        xmltv_program = models.xmltv.Programme(
+            title=[xmltv.models.Title(content=[program.name])],
+            clumpidx=None,
+        )
 
-    # Write EPG XMLTV to target file path
-    write_file_from_xml(filepath, tv, base_url)
+    # Bind current channel to the program
+    xmltv_program.channel = channel['stream_id']
 
+    # Add tags
+    tags = program.tags
+    if 'new' in tags:
+        xmltv_program.new = ''
 
-def postprocess_xml(xml_filepath):
-    """Postprocess output XML file."""
-    xml = ET.parse(xml_filepath)
-    xsi_type = '{http://www.w3.org/2001/XMLSchema-instance}type'
+    if 'live' in tags:
+        xmltv_program.live = ''
 
-    for programme in xml.findall('programme'):
-        programme.attrib.pop(xsi_type, None)
+    # Start / End dates
+    start_ts = datetime.fromtimestamp(program.start_timestamp, tz=timezone.utc)
+    end_ts = datetime.fromtimestamp(program.end_timestamp, tz=timezone.utc)
 
-    xml.write(xml_filepath, pretty_print=True, encoding='utf-8', xml_declaration=True)
+    xmltv_program.start = start_ts.strftime('%Y%m%d%H%M%S %z')
+    xmltv_program.stop = end_ts.strftime('%Y%m%d%H%M%S %z')
 
+    # Add Cast & Crew
+    cast = program.cast
+    if cast:
+        cast.add_cast(xmltv_program)
 
-def write_file_from_xml(xml_filepath, serialize_class, base_url):
-    """Method to write serialized XML data to a file."""
-    serializer = XmlSerializer(config=SerializerConfig(
-        pretty_print=True,
-        encoding='UTF-8',
-        xml_version='1.0',
-        xml_declaration=True,
-        schema_location=furl(base_url).add(path='resources/xmltv.xsd').url
-    ))
+    return xmltv_program
 
-    with xml_filepath.open('w') as data:
-        serializer.write(data, serialize_class)
 
-    postprocess_xml(xml_filepath)
+@staged('xml')
+def make_xmltv(channels, outputs, base_url, create_archive, run_state=None):
+    """Make XMLTV documents out of stored channels and collected programs.
 
+    Every output is a pair of target file path and
+    whether to use channel icons for light background.
+    Programmes don't depend on EPG variant, so every programme
+    is rendered once and written to all outputs. Programmes rendered
+    by the last run are spliced as is, new ones are kept in `run_state`.
+    Returns made documents along with their archives, if any.
+    Programmes of every channel are written by start and indexed,
+    so they could be read by `XmltvReader` without parsing the document.
+    """
+    get_icon = partial(xmltv_icon, base_url=base_url)
 
-async def download_and_make_epg(filepath, parallel, create_archive, images_size,
-                                images_quality, base_url, icons_for_light_bg):
-    """Download channels' programs and make XMLTV EPG."""
-    channels = load_dict('channels.json')
-    download_tasks = [download_programs(channel) for channel in channels]
+    with contextlib.ExitStack() as stack:
+        writers = [
+            stack.enter_context(XmltvWriter(
+                filepath, create_archive,
+                schema_location=furl(base_url).add(path='resources/xmltv.xsd').url,
+                date=datetime.now().strftime('%Y%m%d%H%M%S'),
+                generator_info_name='ustvgo-iptv',
+                generator_info_url='https://github.com/interlark/ustvgo-iptv',
+            ))
+            for filepath, _ in outputs
+        ]
+
+        for writer, (_, icons_for_light_bg) in zip(writers, outputs):
+            for xmltv_channel in make_xmltv_channels(channels, base_url, icons_for_light_bg):
+                writer.write(render_element(xmltv_channel))
+
+        for channel in tqdm(channels, desc='Make EPG XMLTV'):
+            for program in sorted(channel['programs'], key=lambda program: program.start_timestamp):
+                fragment = program.fragment
+                if fragment is not None:
+                    data = fragment.encode('utf-8')
+                    count('programs_reused')
+                else:
+                    data = render_element(make_xmltv_programme(channel, program, get_icon))
+                    count('programs_rebuilt')
+                    if run_state is not None:
+                        remember_program(run_state, channel, program, data)
+
+                for writer in writers:
+                    writer.write_programme(data, channel['stream_id'], program.start_timestamp,
+                                           program.end_timestamp)
+
+    for writer in writers:
+        for filepath in writer.filepaths:
+            count('bytes_written', filepath.stat().st_size)
+
+    return [(writer.filepath, writer.archive_filepath) for writer in writers]
+
+
+async def refresh_epg(session, executor, poster_store, run_state, outputs, parallel,
+                      create_archive, images_size, images_quality, base_url, channels_file,
+                      deadline=None, schedule_source='channel', horizon=12, window=3, shard=None):
+    """Download channels' programs and make XMLTV EPG for every output.
+
+    Only programs which are new or changed since the last run are downloaded
+    and rendered, the rest are reused from `run_state`. With `deadline`
+    EPG is made within that many seconds, with whatever is downloaded by then.
+    Schedules are downloaded per channel or, with "grid" `schedule_source`,
+    all at once along with tags. Tags cover `horizon` hours, downloaded by
+    `window` hours. With `shard` only channels of the shard are taken.
+    Returns programs degraded by deadline along with their channels
+    and made documents along with their archives.
+    """
+    deadline_at = time.monotonic() + deadline * (1 - DEADLINE_RESERVE) if deadline else None
+    channels = load_dict(channels_file)
+    if shard:
+        channels = shard_channels(channels, shard)
+    maintenance = asyncio.ensure_future(maintain_cache())
+
+    # Tags for programs, could be usefull for IPTV recorders.
+    # They are downloaded along with the rest, programs are tagged at the end.
+    grid = None
+    if schedule_source == 'grid':
+        async def grid_airing_attrs():
+            return (await grid).airing_attrs
+
+        grid = asyncio.ensure_future(download_grid_schedules(session, horizon, window))
+        airing_attrs = asyncio.ensure_future(grid_airing_attrs())
+    else:
+        airing_attrs = asyncio.ensure_future(download_program_tags(session, horizon, window))
+
+    # Download programs per each channel from USTVGO, then every changed program
+    # goes through its own chain: details, cast (actors, directors, writers, etc)
+    # and resized images from TVGUIDE
+    reuse = partial(reuse_program, run_state, poster_store)
+    stages = [
+        ('details', partial(download_program_detail, session)),
+        ('cast', partial(download_program_cast, session)),
+        ('posters', partial(download_program_images, session, executor=executor,
+                            poster_store=poster_store, images_size=images_size,
+                            images_quality=images_quality, base_url=base_url)),
+    ]
+    unscheduled = []
+    if deadline_at:
+        unscheduled = await download_by_priority(session, channels, airing_attrs, reuse,
+                                                 stages, parallel, deadline_at, grid)
+    else:
+        await run_pipeline(
+            iter_channels_programs(session, channels, reuse, grid),
+            *[stage_func for _, stage_func in stages],
+            concurrency=parallel, progress_title='Download programs'
+        )
+    await STORE_CACHE.write_back()
 
-    # Download programs per each channel from USTVGO
-    await gather_with_concurrency(parallel, *download_tasks, progress_title='Download programs')
+    if airing_attrs.cancelled():
+        airing_attrs = {}
+    else:
+        try:
+            airing_attrs = await asyncio.wait_for(airing_attrs, time_left(deadline_at))
+        except asyncio.TimeoutError:
+            logger.warning('Deadline reached, programs are not tagged')
+            airing_attrs = {}
+
+    # Programs of the last run tagged otherwise are downloaded
+    # and rendered anew, unless it's too late
+    retagged = tag_programs(channels, airing_attrs)
+    if retagged:
+        count('programs_retagged', len(retagged))
+        prefetch_programs(retagged)
+        try:
+            await asyncio.wait_for(run_pipeline(
+                iter_items(retagged), *[stage_func for _, stage_func in stages], drop_fragment,
+                concurrency=parallel, progress_title='Download retagged programs'
+            ), time_left(deadline_at))
+        except asyncio.TimeoutError:
+            logger.warning('Deadline reached, some programs keep tags of the last run')
+            cancel_in_flight()
+        await STORE_CACHE.write_back()
+
+    # Whatever is downloaded by now is rendered
+    degraded = []
+    if deadline_at:
+        degraded = mark_degraded(channels, unscheduled)
+        log_degraded(degraded)
+
+    # Drop posters no longer referenced
+    with stage('posters_gc'):
+        count('posters_removed', poster_store.collect_garbage())
+        poster_store.save()
+
+    # Cache maintenance is bounded, but not worth missing the deadline
+    await asyncio.wait([maintenance], timeout=time_left(deadline_at))
+    maintenance.cancel()
 
-    # Download program details from TVGUIDE
-    for channel in tqdm(channels, desc='Download details'):
-        download_tasks = [download_program_detail(program) for program in channel['programs']]
-        await gather_with_concurrency(parallel, *download_tasks, show_progress=False)
+    # Make EPG
+    documents = make_xmltv(channels, outputs, base_url, create_archive, run_state)
+    run_state.save()
+
+    return degraded, documents
+
+
+async def serve_epg(refresh, serve_host, serve_port, refresh_interval, metrics_json):
+    """Refresh EPG on schedule and serve the latest one over HTTP.
+
+    Session, caches and process pool stay warm between refreshes.
+    Failed refresh is logged, the previous EPG is served until the next one.
+    """
+    server = EpgServer(serve_host, serve_port, static_dir=root_dir() / 'images')
+    async with server:
+        while True:
+            METRICS.reset()
+            try:
+                degraded, documents = await refresh()
+            except Exception:
+                logger.exception('Failed to refresh EPG')
+            else:
+                server.publish(documents)
+                log_run_summary()
+                if metrics_json:
+                    save_metrics(metrics_json, version=VERSION, hosts=host_metrics(),
+                                 store=COMPACT_STORE.stats(),
+                                 degraded=degraded_metrics(degraded))
+
+            delay = max(0, refresh_interval * 60 - (time.perf_counter() - METRICS.started_at))
+            logger.info('Next refresh in %d s', delay)
+            await asyncio.sleep(delay)
+
+
+async def download_and_make_epg(outputs, parallel, create_archive, images_size,
+                                images_quality, images_grace_period, image_workers, base_url,
+                                channels_file='channels.json', record=None, replay=None,
+                                replay_latency=0, replay_error_rate=0, metrics_json=None,
+                                serve=False, serve_host='0.0.0.0', serve_port=8080,
+                                refresh_interval=30, full_rebuild=False, deadline=None,
+                                schedule_source='channel', horizon=12, window=3, shard=None):
+    """Download channels' programs and make XMLTV EPG for every output.
+
+    Downloaded responses could be recorded into `record` directory and
+    replayed later from `replay` directory (or stand-in server URL).
+    Metrics of the run are saved to `metrics_json` file, if given.
+    With `serve` it runs as a daemon refreshing EPG every
+    `refresh_interval` minutes and serving it over HTTP.
+    Unless `full_rebuild`, unchanged programs of the last run are reused.
+    With `deadline` every EPG is made within that many seconds.
+    With `shard` EPG of the shard's channels is made, to be merged
+    with the other shards by `merge` command. Shards keep their own
+    run state and poster manifest, so they could share the directory.
+    """
+    open_caches()
+    shard_suffix = '.%d-of-%d' % shard if shard else ''
+    poster_store = PosterStore(root_dir() / 'images' / 'posters',
+                               grace_period=images_grace_period * 3600,
+                               manifest_name=f'manifest{shard_suffix}.json')
+
+    # Rendered programmes depend on these settings as well
+    settings = {'version': VERSION, 'base_url': base_url, 'images_size': images_size,
+                'images_quality': images_quality, 'xmltv': XMLTV_PROGRAM_OPTIONS}
+    run_state = RunState(root_dir() / 'cache' / f'run_state{shard_suffix}.json.gz', settings,
+                         max_age=CACHE_POLICIES['details'].ttl)
+    if full_rebuild:
+        run_state.entries.clear()
+
+    if record:
+        start_recording(record)
+
+    async with contextlib.AsyncExitStack() as stack:
+        if replay:
+            await stack.enter_async_context(replaying(
+                replay, latency=replay_latency / 1000, error_rate=replay_error_rate
+            ))
+
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=image_workers))
+        session = await stack.enter_async_context(create_session())
+
+        refresh = partial(refresh_epg, session, executor, poster_store, run_state, outputs,
+                          parallel, create_archive, images_size, images_quality, base_url,
+                          channels_file, deadline, schedule_source, horizon, window, shard)
+        if serve:
+            await serve_epg(refresh, serve_host, serve_port, refresh_interval, metrics_json)
+            return
+
+        degraded, _ = await refresh()
+
+    log_run_summary()
+    if metrics_json:
+        save_metrics(metrics_json, version=VERSION, hosts=host_metrics(),
+                     store=COMPACT_STORE.stats(), degraded=degraded_metrics(degraded))
+
+
+def output_target(value):
+    """Parse output target "path[:light|:dark]"."""
+    filepath, _, variant = value.rpartition(':')
+    if variant not in ('light', 'dark'):
+        filepath, variant = value, 'dark'
+
+    if not filepath:
+        raise argparse.ArgumentTypeError(f'Invalid output "{value}"')
+
+    return pathlib.Path(filepath), variant == 'light'
+
+
+def shard_spec(value):
+    """Parse shard "k/n", the k-th of n."""
+    try:
+        k, n = map(int, value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid shard "{value}"')
+
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f'Invalid shard "{value}"')
+
+    return k, n
+
+
+def merge_command(argv):
+    """Merge EPG of shards into one, in order of channels file."""
+    parser = argparse.ArgumentParser('epg-downloader merge')
+    parser.add_argument('filepath', type=pathlib.Path, help='Merged EPG')
+    parser.add_argument('shards', metavar='SHARD', type=pathlib.Path, nargs='+',
+                        help='EPG of shard, every one of them')
+    parser.add_argument(
+        '--create-archive', '-a', action='store_true',
+        help='Create archive of merged XML'
+    )
+    parser.add_argument(
+        '--channels', metavar='FILE', default='channels.json', dest='channels_file',
+        help='Channels file, channels are merged in its order (default: %(default)s)'
+    )
+    args = parser.parse_args(argv)
+
+    channel_ids = [channel['stream_id'] for channel in load_dict(args.channels_file)]
+    try:
+        result = merge_documents(args.filepath, args.shards, channel_ids, args.create_archive)
+    except (OSError, XMLSyntaxError) as e:
+        logger.error('Failed to merge shards: %s', e)
+        sys.exit(1)
+
+    logger.info('Merged %d channels, %d programmes of %d shards into %s',
+                len(result.channel_ids), result.programmes, len(args.shards), args.filepath)
+    if result.duplicates:
+        logger.warning('Skipped %d elements of channels found in several shards',
+                       result.duplicates)
+
+    missing = set(channel_ids) - set(result.channel_ids)
+    if missing:
+        logger.warning('%d channels are missing, not every shard is merged? %s',
+                       len(missing), ', '.join(sorted(missing)[:10]))
+
+
+def cache_command(argv):
+    """Look into caches and clean them up, off the hot path of runs."""
+    parser = argparse.ArgumentParser('epg-downloader cache')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+    commands.add_parser('stats', help='Show number of entries and size of caches')
+    commands.add_parser('vacuum', help='Remove every expired entry and compact the store')
+    prune = commands.add_parser('prune', help='Remove entries of the store stored long ago')
+    prune.add_argument(
+        '--older-than', type=int, metavar='HOURS', required=True,
+        help='Remove entries stored more than HOURS ago'
+    )
+    evict = commands.add_parser('evict', help='Remove every entry of namespace')
+    evict.add_argument(
+        '--namespace', choices=[*NAMESPACES, 'responses'], required=True,
+        help='Namespace of the store, or "responses" of schedules, tags and failed images'
+    )
+    args = parser.parse_args(argv)
 
-    # Download program cast (actors, directors, writers, etc) from TVGUIDE
-    for channel in tqdm(channels, desc='Download credits'):
-        download_tasks = [download_program_cast(program) for program in channel['programs']]
-        await gather_with_concurrency(parallel, *download_tasks, show_progress=False)
+    if args.command == 'prune' and args.older_than < 0:
+        parser.error('Invalid arguments')
 
-    # Download and resize images from TVGUIDE
-    shutil.rmtree(root_dir() / 'images' / 'posters', ignore_errors=True)  # Remove old imgs first
-    for channel in tqdm(channels, desc='Download images'):
-        download_tasks = [download_program_images(program, images_size, images_quality, base_url)
-                          for program in channel['programs']]
-        await gather_with_concurrency(parallel, *download_tasks, show_progress=False)
+    open_caches()
+
+    if args.command == 'vacuum':
+        removed = COMPACT_STORE.expire() + DISK_CACHE.expire()
+        COMPACT_STORE.vacuum()
+        logger.info('Removed %d expired entries', removed)
+    elif args.command == 'prune':
+        removed = COMPACT_STORE.prune(args.older_than * 3600)
+        logger.info('Removed %d entries stored more than %d hours ago', removed, args.older_than)
+    elif args.command == 'evict':
+        if args.namespace == 'responses':
+            removed = DISK_CACHE.clear()
+        else:
+            removed = COMPACT_STORE.evict(args.namespace)
+        logger.info('Removed %d entries of %s', removed, args.namespace)
 
-    # Add tags for programs,
-    # could be usefull for IPTV recorders.
-    await download_program_tags(channels)
+    log_cache_stats()
 
-    # Make EPG
-    make_xmltv(channels, filepath, base_url, icons_for_light_bg)
 
-    if create_archive:
-        with gzip.open(f'{filepath}.gz', 'wb') as f:
-            f.write(filepath.read_bytes())
+def main():
+    if sys.argv[1:2] == ['cache']:
+        cache_command(sys.argv[2:])
+        return
 
+    if sys.argv[1:2] == ['merge']:
+        merge_command(sys.argv[2:])
+        return
 
-def main():
     parser = argparse.ArgumentParser('epg-downloader')
-    parser.add_argument('filepath', type=pathlib.Path)
+    parser.add_argument('filepath', type=pathlib.Path, nargs='?')
+    parser.add_argument(
+        '--output', '-o', metavar='PATH[:light]', type=output_target,
+        action='append', default=[], dest='outputs',
+        help='Add output target, channel icons adapted for light background '
+             'are put with ":light" suffix (could be repeated)'
+    )
     parser.add_argument(
         '--parallel', '-p', metavar='N', type=int, default=10,
-        help='Number of parallel requests (default: %(default)s)'
+        help='Number of parallel workers per download stage (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--host-limit', metavar='HOST=N[/RATE]', type=host_policy, action='append',
+        default=[], dest='host_limits',
+        help='Limit requests to HOST to N at once and RATE per second (could be repeated)'
     )
     parser.add_argument(
         '--create-archive', '-a', action='store_true',
@@ -406,6 +1365,14 @@ def main():
         '--images-quality', type=int, metavar='N', default=80,
         help='Set images quality (default: %(default)s)'
     )
+    parser.add_argument(
+        '--images-grace-period', type=int, metavar='HOURS', default=48,
+        help='Keep unreferenced images for HOURS before removal (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--image-workers', type=int, metavar='N', default=os.cpu_count(),
+        help='Number of processes resizing images (default: %(default)s)'
+    )
     parser.add_argument(
         '--base-url', metavar='URL',
         default='https://raw.githubusercontent.com/interlark/ustvgo-tvguide/master',
@@ -413,17 +1380,109 @@ def main():
     )
     parser.add_argument(
         '--icons-for-light-bg', action='store_true',
-        help='Put channel icons adapted for light background'
+        help='Put channel icons adapted for light background into FILEPATH'
+    )
+    parser.add_argument(
+        '--channels', metavar='FILE', default='channels.json', dest='channels_file',
+        help='Channels file (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--record', metavar='DIR',
+        help='Record downloaded responses into DIR'
+    )
+    parser.add_argument(
+        '--replay', metavar='DIR|URL',
+        help='Replay responses recorded into DIR, or served by stand-in server at URL'
+    )
+    parser.add_argument(
+        '--replay-latency', type=int, metavar='MS', default=0,
+        help='Delay replayed responses by MS milliseconds (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--replay-error-rate', type=float, metavar='P', default=0,
+        help='Fail replayed responses with probability P (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--schedule-source', choices=['channel', 'grid'], default='channel',
+        help='Download schedules per channel from USTVGO, or all at once from '
+             'tvguide.com grid with per channel fallback (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--horizon', type=int, metavar='HOURS', default=12,
+        help='Tag programs airing within HOURS (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--window', type=int, metavar='HOURS', default=3,
+        help='Download tags by windows of HOURS in parallel (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--deadline', type=int, metavar='SECONDS',
+        help='Make EPG within SECONDS, with programs airing soonest enriched first'
+    )
+    parser.add_argument(
+        '--shard', type=shard_spec, metavar='K/N',
+        help='Make EPG of the K-th shard of N, channels sharing schedule go '
+             'to the same shard; shards are combined by "merge" command'
+    )
+    parser.add_argument(
+        '--full-rebuild', action='store_true',
+        help='Download and render every program, not only new and changed ones'
+    )
+    parser.add_argument(
+        '--serve', action='store_true',
+        help='Run as daemon refreshing EPG on schedule and serving it over HTTP'
+    )
+    parser.add_argument(
+        '--serve-host', metavar='HOST', default='0.0.0.0',
+        help='Serve EPG on HOST (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--serve-port', type=int, metavar='PORT', default=8080,
+        help='Serve EPG on PORT (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--refresh-interval', type=int, metavar='MINUTES', default=30,
+        help='Refresh served EPG every MINUTES (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--metrics-json', type=pathlib.Path, metavar='FILE',
+        help='Save metrics of the run (time, requests, cache, latency per stage) into FILE'
+    )
+    parser.add_argument(
+        '--profile', choices=['cpu', 'memory'],
+        help='Profile the run with cProfile or tracemalloc, '
+             'stats are saved next to the first output'
     )
     parser.add_argument(
         '--version', '-v', action='version', version=f'%(prog)s {VERSION}'
     )
     args = parser.parse_args()
 
-    if args.parallel <= 0 or args.images_size <= 0 or args.images_quality <= 0:
+    if args.filepath:
+        args.outputs.insert(0, (args.filepath, args.icons_for_light_bg))
+    del args.filepath, args.icons_for_light_bg
+
+    if not args.outputs:
+        parser.error('No output target given')
+
+    HOST_POLICIES.update(args.host_limits)
+    del args.host_limits
+
+    if args.parallel <= 0 or args.images_size <= 0 or args.images_quality <= 0 \
+            or args.image_workers <= 0 or args.images_grace_period < 0 \
+            or args.replay_latency < 0 or not 0 <= args.replay_error_rate <= 1 \
+            or args.refresh_interval <= 0 or args.horizon <= 0 or args.window <= 0 \
+            or (args.deadline is not None and args.deadline <= 0):
         parser.error('Invalid arguments')
 
-    asyncio.run(download_and_make_epg(**vars(args)))
+    profile = args.profile
+    del args.profile
+
+    with profiling(profile, args.outputs[0][0]):
+        try:
+            asyncio.run(download_and_make_epg(**vars(args)))
+        except KeyboardInterrupt:
+            logger.info('Interrupted')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import email.utils
+import random
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+from furl import furl
+
+# Response statuses telling the host is overloaded
+THROTTLE_STATUSES = (429, 503)
+
+BACKOFF_BASE = 0.5  # Seconds
+BACKOFF_MAX = 30  # Seconds
+
+
+class HostPolicy(NamedTuple):
+    max_concurrency: int
+    rate: float = 0  # Requests per second, 0 - unlimited
+    burst: int = 1  # Requests allowed at once on top of rate
+    min_concurrency: int = 1
+
+
+HOST_POLICIES = {
+    # Throttles aggressively
+    'cmg-prod.apigee.net': HostPolicy(max_concurrency=10, rate=20, burst=10),
+    'ustvgo.tv': HostPolicy(max_concurrency=20),
+    # Image CDN
+    'www.tvguide.com': HostPolicy(max_concurrency=30),
+}
+
+# Policy of hosts not listed above
+DEFAULT_HOST_POLICY = HostPolicy(max_concurrency=10)
+
+# Limiters of hosts, created on first request
+HOST_LIMITERS = {}
+
+
+class HostLimiter:
+    """Limiter of requests to a single host.
+
+    Concurrency adapts AIMD-style: it grows by one per window of successful
+    requests and halves when the host throttles or times out. Rate is capped
+    with token bucket, `Retry-After` pauses all requests to the host.
+    """
+
+    def __init__(self, host, policy):
+        self.host = host
+        self.policy = policy
+        self.limit = max(policy.min_concurrency, policy.max_concurrency // 2)
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.tokens = policy.burst
+        self.tokens_updated_at = time.monotonic()
+        self.paused_until = 0
+
+        # Stats
+        self.requests = 0
+        self.throttles = 0
+        self.started_at = None
+        self.finished_at = None
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+        try:
+            await self.wait_for_turn()
+        except BaseException:
+            await self.release()
+            raise
+
+        self.requests += 1
+        self.started_at = self.started_at or time.monotonic()
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def wait_for_turn(self):
+        """Wait for pause to end and for rate limit token."""
+        while True:
+            now = time.monotonic()
+            if self.paused_until > now:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+
+            if not self.policy.rate:
+                return
+
+            elapsed = now - self.tokens_updated_at
+            self.tokens = min(self.policy.burst, self.tokens + elapsed * self.policy.rate)
+            self.tokens_updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.policy.rate)
+
+    def on_success(self):
+        """Additive increase."""
+        self.limit = min(self.policy.max_concurrency, self.limit + 1 / self.limit)
+        self.finished_at = time.monotonic()
+
+    def on_throttle(self, retry_after=None):
+        """Multiplicative decrease, pause the host if asked to."""
+        self.throttles += 1
+        self.limit = max(self.policy.min_concurrency, self.limit / 2)
+        self.finished_at = time.monotonic()
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    @property
+    def throughput(self):
+        """Requests per second."""
+        if not self.started_at or not self.finished_at or self.finished_at <= self.started_at:
+            return 0.0
+
+        return self.requests / (self.finished_at - self.started_at)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.release()
+
+
+def host_limiter(url):
+    """Get limiter of URL host."""
+    host = furl(url).host
+    if host not in HOST_LIMITERS:
+        policy = HOST_POLICIES.get(host, DEFAULT_HOST_POLICY)
+        HOST_LIMITERS[host] = HostLimiter(host, policy)
+
+    return HOST_LIMITERS[host]
+
+
+def parse_retry_after(value):
+    """Parse `Retry-After` header, seconds or HTTP date, into seconds."""
+    if not value:
+        return None
+
+    if value.strip().isdigit():
+        return int(value)
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(retry, retry_after=None):
+    """Exponential backoff delay with full jitter."""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (retry - 1)))
+    if retry_after:
+        delay = max(delay, retry_after)
+
+    return delay
+
+
+def host_policy(value):
+    """Parse host policy "HOST=CONCURRENCY[/RATE]"."""
+    try:
+        host, _, limits = value.partition('=')
+        concurrency, _, rate = limits.partition('/')
+        policy = HostPolicy(max_concurrency=int(concurrency), rate=float(rate or 0),
+                            burst=max(1, int(concurrency)))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid host limit "{value}"')
+
+    if not host or policy.max_concurrency <= 0 or policy.rate < 0:
+        raise argparse.ArgumentTypeError(f'Invalid host limit "{value}"')
+
+    return host, policy
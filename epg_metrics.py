@@ -0,0 +1,181 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import cProfile
+import functools
+import json
+import time
+import tracemalloc
+
+from ustvgo_iptv import logger
+
+# Stage of the run the current task works on
+CURRENT_STAGE = contextvars.ContextVar('stage', default='other')
+
+PERCENTILES = (50, 95, 99)
+
+
+class StageMetrics:
+    """Time spent in a stage and counters of the stage.
+
+    Calls of stage functions overlap, so `wall` is the span from the first
+    call to the end of the last one, while `busy` is the sum of calls.
+    """
+
+    def __init__(self):
+        self.started_at = None
+        self.finished_at = None
+        self.busy = 0.0
+        self.calls = 0
+        self.counters = collections.Counter()
+
+    def add_call(self, started_at, finished_at):
+        self.started_at = min(self.started_at or started_at, started_at)
+        self.finished_at = max(self.finished_at or finished_at, finished_at)
+        self.busy += finished_at - started_at
+        self.calls += 1
+
+    @property
+    def wall(self):
+        if self.started_at is None:
+            return 0.0
+
+        return self.finished_at - self.started_at
+
+    def to_dict(self):
+        return {
+            'wall_seconds': round(self.wall, 6),
+            'busy_seconds': round(self.busy, 6),
+            'calls': self.calls,
+            **{k: round(v, 6) if isinstance(v, float) else v
+               for k, v in sorted(self.counters.items())},
+        }
+
+
+class Metrics:
+    """Metrics of the run: stages and request latencies per host."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Start metrics of a new run."""
+        self.started_at = time.perf_counter()
+        self.stages = {}  # By name, in order of appearance
+        self.latencies = collections.defaultdict(list)  # Seconds per host
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageMetrics()
+
+        return self.stages[name]
+
+    def total(self, counter):
+        """Sum of counter over all stages."""
+        return sum(stage.counters[counter] for stage in self.stages.values())
+
+    def to_dict(self):
+        return {
+            'wall_seconds': round(time.perf_counter() - self.started_at, 6),
+            'stages': {name: stage.to_dict() for name, stage in self.stages.items()},
+            'latency': {host: latency_percentiles(latencies)
+                        for host, latencies in self.latencies.items()},
+        }
+
+
+METRICS = Metrics()
+
+
+def count(counter, value=1):
+    """Increase counter of the current stage."""
+    METRICS.stage(CURRENT_STAGE.get()).counters[counter] += value
+
+
+def observe_latency(host, seconds):
+    """Record latency of request to host."""
+    METRICS.latencies[host].append(seconds)
+
+
+def latency_percentiles(latencies):
+    """Nearest-rank percentiles of latencies, in seconds."""
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+
+    percentiles = {'count': len(latencies)}
+    for percentile in PERCENTILES:
+        rank = max(1, -(-len(latencies) * percentile // 100))
+        percentiles[f'p{percentile}'] = round(latencies[rank - 1], 6)
+    percentiles['max'] = round(latencies[-1], 6)
+
+    return percentiles
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Attribute time and counters of the block to stage."""
+    token = CURRENT_STAGE.set(name)
+    started_at = time.perf_counter()
+    try:
+        yield METRICS.stage(name)
+    finally:
+        METRICS.stage(name).add_call(started_at, time.perf_counter())
+        CURRENT_STAGE.reset(token)
+
+
+def staged(name):
+    """Decorator running function, sync or async, within stage."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def inner(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def inner(*args, **kwargs):
+                with stage(name):
+                    return func(*args, **kwargs)
+
+        return inner
+
+    return decorator
+
+
+def save_metrics(filepath, **extra):
+    """Save metrics of the run to JSON file."""
+    data = {**METRICS.to_dict(), **extra}
+    filepath.write_text(json.dumps(data, indent=2), encoding='utf-8')
+
+
+@contextlib.contextmanager
+def profiling(kind, filepath):
+    """Profile the block with cProfile ("cpu") or tracemalloc ("memory")
+    and dump stats next to `filepath`."""
+    if kind == 'cpu':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            stats_filepath = filepath.with_name(filepath.name + '.prof')
+            profiler.dump_stats(stats_filepath)
+            logger.info('CPU profile saved to %s', stats_filepath)
+    elif kind == 'memory':
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stats_filepath = filepath.with_name(filepath.name + '.tracemalloc')
+            snapshot.dump(str(stats_filepath))
+            logger.info('Memory snapshot saved to %s, peak traced memory %.1f MB',
+                        stats_filepath, peak / 2**20)
+            for stat in snapshot.statistics('lineno')[:10]:
+                logger.info('  %s', stat)
+    else:
+        yield
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import pathlib
+import time
+
+
+class PosterStore:
+    """Content-addressed store of resized posters.
+
+    Posters are keyed by bucket path, size and quality, the manifest keeps
+    their dimensions and the last time a run referenced them. Stores of
+    shards share posters, every one of them keeps its own manifest.
+    """
+    MANIFEST_NAME = 'manifest.json'
+
+    def __init__(self, root, grace_period, manifest_name=MANIFEST_NAME):
+        self.root = pathlib.Path(root)
+        self.grace_period = grace_period  # Seconds
+        self.manifest_path = self.root / manifest_name
+        self.manifest = {}
+        self.started_at = int(time.time())
+
+        if self.manifest_path.exists():
+            self.manifest = json.loads(self.manifest_path.read_text(encoding='utf-8'))
+
+    @staticmethod
+    def make_key(bucket_path, size, quality):
+        """Key of resized poster."""
+        key = f'{bucket_path}|{size}|{quality}'
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Get stored poster entry, mark it as referenced."""
+        entry = self.manifest.get(key)
+        if entry and (self.root / entry['path']).exists():
+            entry['last_used'] = self.started_at
+            return entry
+
+        return None
+
+    def put(self, key, data, width, height, suffix=''):
+        """Store poster bytes, return its entry."""
+        path = pathlib.PurePosixPath(key[:2]) / f'{key}{suffix}'
+        filepath = self.root / path
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_filepath = filepath.with_name(filepath.name + '.tmp')
+        tmp_filepath.write_bytes(data)
+        os.replace(tmp_filepath, filepath)
+
+        entry = {'path': str(path), 'width': width, 'height': height,
+                 'last_used': self.started_at}
+        self.manifest[key] = entry
+        return entry
+
+    def collect_garbage(self):
+        """Remove posters not referenced for longer than grace period,
+        by this or other manifests.
+
+        Returns number of removed files.
+        """
+        expired_before = self.started_at - self.grace_period
+        for key, entry in list(self.manifest.items()):
+            if entry['last_used'] < expired_before:
+                del self.manifest[key]
+
+        removed = 0
+        stored_paths = {self.root / entry['path'] for entry in self.manifest.values()}
+        manifest_paths = set(self.root.glob('manifest*.json')) | {self.manifest_path}
+        for manifest_path in manifest_paths - {self.manifest_path}:
+            try:
+                manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+            except (OSError, ValueError):
+                return 0  # Not sure what is referenced, better remove nothing
+            stored_paths.update(self.root / entry['path'] for entry in manifest.values()
+                                if entry['last_used'] >= expired_before)
+
+        for filepath in list(self.root.rglob('*')):
+            if filepath.is_file() and filepath not in manifest_paths \
+                    and filepath not in stored_paths \
+                    and filepath.stat().st_mtime < expired_before:
+                filepath.unlink()
+                removed += 1
+
+        # Remove empty directories, deepest first
+        for dirpath in sorted(self.root.rglob('*'), reverse=True):
+            if dirpath.is_dir() and not any(dirpath.iterdir()):
+                dirpath.rmdir()
+
+        return removed
+
+    def save(self):
+        """Save manifest."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+        tmp_path.write_text(json.dumps(self.manifest, indent=2, sort_keys=True), encoding='utf-8')
+        os.replace(tmp_path, self.manifest_path)
+
+        # The next run in the same process references posters anew
+        self.started_at = int(time.time())
@@ -0,0 +1,197 @@
+import sys
+from array import array
+
+# Tags of programs, by bit
+TAGS = ('new', 'live')
+
+# Stages programs may miss by deadline, by bit
+STAGES = ('details', 'cast', 'posters')
+
+# Size of SHA-1 digest
+FINGERPRINT_SIZE = 20
+
+
+def to_bits(names, all_names):
+    """Bit mask of names."""
+    return sum(1 << all_names.index(name) for name in set(names))
+
+
+def from_bits(bits, all_names):
+    """Names of bit mask, in order of `all_names`."""
+    return [name for idx, name in enumerate(all_names) if bits & (1 << idx)]
+
+
+class ProgramStores:
+    """Downloads of programs kept once for programs of all channels.
+
+    Details and poster keys are kept by program ID, cast - by its ID
+    (`mcoId` of details), so programs airing on several channels or
+    several times, and episodes of the same show, share them.
+    """
+
+    def __init__(self):
+        self.details = {}
+        self.casts = {}
+        self.posters = {}
+
+
+class ProgramTable:
+    """Programs of a channel, column by column.
+
+    IDs and timestamps are kept in arrays, names are interned, tags and
+    stages missed by deadline are bit masks, fingerprints of program sources
+    are digests. Downloads are kept in `stores`, shared by tables of all
+    channels. Programs are accessed by `ProgramRow`, made on the fly.
+    """
+
+    def __init__(self, stores):
+        self.stores = stores
+        self.ids = array('q')
+        self.starts = array('q')
+        self.ends = array('q')
+        self.names = []
+        self.fingerprints = bytearray()
+        self.tags = array('B')
+        self.fragment_tags = array('B')
+        self.degraded = array('B')
+        self.fragments = []  # Rendered by the last run
+
+    def append(self, program_id, name, start_timestamp, end_timestamp, source_fingerprint):
+        self.ids.append(program_id)
+        self.starts.append(start_timestamp)
+        self.ends.append(end_timestamp)
+        self.names.append(sys.intern(name))
+        self.fingerprints += bytes.fromhex(source_fingerprint)
+        self.tags.append(0)
+        self.fragment_tags.append(0)
+        self.degraded.append(0)
+        self.fragments.append(None)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for idx in range(len(self.ids)):
+            yield ProgramRow(self, idx)
+
+
+class ProgramRow:
+    """Program of a table.
+
+    Rows of the same program are equal, whatever row is made for it.
+    """
+    __slots__ = ('table', 'idx')
+
+    def __init__(self, table, idx):
+        self.table = table
+        self.idx = idx
+
+    def __eq__(self, other):
+        return isinstance(other, ProgramRow) \
+            and self.table is other.table and self.idx == other.idx
+
+    def __hash__(self):
+        return hash((id(self.table), self.idx))
+
+    def __repr__(self):
+        return f'ProgramRow(id={self.id}, name={self.name!r}, start_timestamp={self.start_timestamp})'
+
+    @property
+    def stores(self):
+        return self.table.stores
+
+    @property
+    def id(self):
+        return self.table.ids[self.idx]
+
+    @property
+    def name(self):
+        return self.table.names[self.idx]
+
+    @property
+    def start_timestamp(self):
+        return self.table.starts[self.idx]
+
+    @property
+    def end_timestamp(self):
+        return self.table.ends[self.idx]
+
+    @property
+    def fingerprint(self):
+        """Fingerprint of program source."""
+        offset = self.idx * FINGERPRINT_SIZE
+        return self.table.fingerprints[offset:offset + FINGERPRINT_SIZE].hex()
+
+    @property
+    def tags(self):
+        return from_bits(self.table.tags[self.idx], TAGS)
+
+    @tags.setter
+    def tags(self, tags):
+        self.table.tags[self.idx] = to_bits(tags, TAGS)
+
+    @property
+    def fragment(self):
+        """Programme rendered by the last run, as text."""
+        return self.table.fragments[self.idx]
+
+    @fragment.setter
+    def fragment(self, fragment):
+        self.table.fragments[self.idx] = fragment
+
+    @property
+    def fragment_tags(self):
+        return from_bits(self.table.fragment_tags[self.idx], TAGS)
+
+    @fragment_tags.setter
+    def fragment_tags(self, tags):
+        self.table.fragment_tags[self.idx] = to_bits(tags, TAGS)
+
+    @property
+    def degraded(self):
+        """Stages skipped by deadline."""
+        return from_bits(self.table.degraded[self.idx], STAGES)
+
+    @degraded.setter
+    def degraded(self, stages):
+        self.table.degraded[self.idx] = to_bits(stages, STAGES)
+
+    @property
+    def missing(self):
+        """Stages the program lacks downloads of, whichever airing made them.
+
+        Details known to be empty are not missing, nor is their cast.
+        """
+        if self.id not in self.stores.details:
+            return list(STAGES)
+
+        details = self.details
+        if not details:
+            return []
+
+        return [stage for stage, is_missing in [
+            ('cast', details.mcoId and details.mcoId not in self.stores.casts),
+            ('posters', any(image.bucketType != 'local' for image in details.images)),
+        ] if is_missing]
+
+    @property
+    def details(self):
+        return self.stores.details.get(self.id)
+
+    @property
+    def cast(self):
+        details = self.details
+        return self.stores.casts.get(details.mcoId) if details and details.mcoId else None
+
+    @cast.setter
+    def cast(self, cast):
+        self.stores.casts[self.details.mcoId] = cast
+
+    @property
+    def posters(self):
+        """Keys of stored posters, None if they are not stored yet."""
+        return self.stores.posters.get(self.id)
+
+    @posters.setter
+    def posters(self, posters):
+        self.stores.posters[self.id] = posters
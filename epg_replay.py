@@ -0,0 +1,161 @@
+import asyncio
+import collections
+import contextlib
+import hashlib
+import json
+import pathlib
+import random
+
+from aiohttp import web
+from furl import furl
+
+from epg_cache import normalize_url
+
+# Response headers worth keeping in recordings
+RECORDED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+# Recorder of downloaded responses, if recording
+RECORDER = None
+
+# Base URL of stand-in server, if replaying
+REPLAY_URL = None
+
+
+def response_name(url):
+    """Name of recorded response files."""
+    return hashlib.sha1(normalize_url(url).encode('utf-8')).hexdigest()
+
+
+class Recorder:
+    """Recorder of responses into directory, a pair of files per response:
+    `<name>.json` with URL, status and headers and `<name>.body`."""
+
+    def __init__(self, dirpath):
+        self.dirpath = pathlib.Path(dirpath)
+        self.dirpath.mkdir(parents=True, exist_ok=True)
+
+    def record(self, url, status, headers, body):
+        name = response_name(url)
+        (self.dirpath / f'{name}.body').write_bytes(body)
+
+        meta = {
+            'url': url,
+            'status': status,
+            'headers': {k: headers[k] for k in RECORDED_HEADERS if k in headers},
+        }
+        (self.dirpath / f'{name}.json').write_text(json.dumps(meta), encoding='utf-8')
+
+
+def start_recording(dirpath):
+    """Record every downloaded response into directory."""
+    global RECORDER
+    RECORDER = Recorder(dirpath)
+
+
+async def record_response(url, response):
+    """Record downloaded response, if recording."""
+    if RECORDER:
+        RECORDER.record(url, response.status, response.headers, await response.read())
+
+
+def replay_url(url):
+    """URL of the same resource on stand-in server, if replaying."""
+    if not REPLAY_URL:
+        return url
+
+    url = furl(url)
+    replay = f'{REPLAY_URL.rstrip("/")}/{url.host}{url.path}'
+    if url.query.params:
+        replay += f'?{url.query}'
+
+    return replay
+
+
+class ReplayServer:
+    """Stand-in server replaying recorded responses.
+
+    Every response is delayed by `latency` seconds and
+    fails with 503 status with `error_rate` probability.
+    """
+
+    def __init__(self, dirpath, latency=0, error_rate=0, host='127.0.0.1', port=0):
+        self.dirpath = pathlib.Path(dirpath)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.host = host
+        self.port = port
+        self.url = None
+        self.runner = None
+        self.hits = collections.Counter()  # Requests per original URL
+
+        # Recordings by normalized URL and, as a fallback
+        # for URLs with volatile query, by path
+        self.by_url, self.by_path = {}, {}
+        for meta_path in self.dirpath.glob('*.json'):
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+            recording = (meta, meta_path.with_suffix('.body'))
+            self.by_url[normalize_url(meta['url'])] = recording
+            self.by_path[furl(meta['url']).remove(query=True).url] = recording
+
+    def lookup(self, url):
+        return self.by_url.get(normalize_url(url)) \
+            or self.by_path.get(furl(url).remove(query=True).url)
+
+    async def handle(self, request):
+        url = 'https://%s/%s' % (request.match_info['host'], request.match_info['path'])
+        if request.query_string:
+            url += f'?{request.query_string}'
+        self.hits[url] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.error_rate and random.random() < self.error_rate:
+            return web.Response(status=503)
+
+        recording = self.lookup(url)
+        if not recording:
+            return web.Response(status=404)
+
+        meta, body_path = recording
+        headers = meta['headers']
+        if headers.get('ETag') and request.headers.get('If-None-Match') == headers['ETag']:
+            return web.Response(status=304, headers=headers)
+
+        return web.Response(status=meta['status'], headers=headers, body=body_path.read_bytes())
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get('/{host}/{path:.*}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+
+        port = self.runner.addresses[0][1]
+        self.url = f'http://{self.host}:{port}'
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.runner.cleanup()
+
+
+@contextlib.asynccontextmanager
+async def replaying(source, latency=0, error_rate=0):
+    """Replay responses from recordings directory,
+    or from already running stand-in server at URL."""
+    global REPLAY_URL
+
+    async with contextlib.AsyncExitStack() as stack:
+        if str(source).startswith(('http://', 'https://')):
+            REPLAY_URL = str(source)
+        else:
+            server = await stack.enter_async_context(
+                ReplayServer(source, latency=latency, error_rate=error_rate)
+            )
+            REPLAY_URL = server.url
+
+        try:
+            yield REPLAY_URL
+        finally:
+            REPLAY_URL = None
@@ -0,0 +1,109 @@
+import gzip
+import hashlib
+import pathlib
+from email.utils import formatdate
+from typing import NamedTuple
+
+from aiohttp import web
+
+from ustvgo_iptv import logger
+
+CONTENT_TYPES = {
+    '.xml': 'application/xml; charset=utf-8',
+    '.gz': 'application/gzip',
+}
+
+
+class Document(NamedTuple):
+    body: bytes
+    gzip_body: bytes  # Precompressed body
+    etag: str
+    last_modified: str
+
+
+def load_document(filepath, archive_filepath=None):
+    """Load document with its archive, made along or compressed now."""
+    body = filepath.read_bytes()
+    gzip_body = archive_filepath.read_bytes() if archive_filepath else gzip.compress(body)
+    etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+    return Document(body, gzip_body, etag, formatdate(filepath.stat().st_mtime, usegmt=True))
+
+
+class EpgServer:
+    """HTTP server of EPG documents kept in memory.
+
+    Every document is served as is or gzip encoded, its archive as
+    `<name>.gz`. New documents are published at once, clients polling
+    with `If-None-Match` get 304 until then.
+    """
+
+    def __init__(self, host='0.0.0.0', port=8080, static_dir=None):
+        self.host = host
+        self.port = port
+        self.static_dir = static_dir
+        self.documents = {}  # By name
+        self.runner = None
+
+    def publish(self, filepaths):
+        """Load documents and swap them with served ones.
+
+        Every document comes with its archive made along, None if there's
+        none, archives left by other runs are not served.
+        """
+        documents = {}
+        for filepath, archive_filepath in filepaths:
+            document = load_document(pathlib.Path(filepath),
+                                     archive_filepath and pathlib.Path(archive_filepath))
+            documents[filepath.name] = document
+            documents[filepath.name + '.gz'] = document
+
+        self.documents = documents
+        logger.info('Serving %s', ', '.join(sorted(documents)))
+
+    async def handle(self, request):
+        name = request.match_info['name']
+        document = self.documents.get(name)
+        if document is None:
+            if not self.documents:
+                # Nothing to serve until the first EPG is made
+                raise web.HTTPServiceUnavailable(headers={'Retry-After': '60'})
+            raise web.HTTPNotFound()
+
+        is_archive = name.endswith('.gz')
+        is_encoded = not is_archive and 'gzip' in request.headers.get('Accept-Encoding', '')
+
+        etag = document.etag
+        if is_archive or is_encoded:
+            etag = etag[:-1] + '-gz"'
+
+        headers = {
+            'ETag': etag,
+            'Last-Modified': document.last_modified,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+        }
+        if etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+
+        headers['Content-Type'] = CONTENT_TYPES['.gz' if is_archive else '.xml']
+        if is_encoded:
+            headers['Content-Encoding'] = 'gzip'
+
+        body = document.gzip_body if is_archive or is_encoded else document.body
+        return web.Response(body=body, headers=headers)
+
+    async def __aenter__(self):
+        app = web.Application()
+        if self.static_dir:
+            app.router.add_static('/images', self.static_dir)
+        app.router.add_get('/{name}', self.handle)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info('Listening on http://%s:%d', self.host, self.port)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.runner.cleanup()
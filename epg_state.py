@@ -0,0 +1,79 @@
+import gzip
+import hashlib
+import json
+import os
+import pathlib
+import time
+
+
+def fingerprint(data):
+    """Fingerprint of JSON serializable data."""
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class RunState:
+    """State of the last run: rendered programmes to reuse.
+
+    Programmes are keyed by channel, program ID and start timestamp, every
+    entry keeps fingerprint of its source, rendered `<programme>` fragment,
+    keys of its posters and its tags. State made with different `settings`
+    is dropped. Only entries put during the current run are saved, ended
+    ones are not.
+    """
+
+    def __init__(self, filepath, settings, max_age):
+        self.filepath = pathlib.Path(filepath)
+        self.settings = fingerprint(settings)
+        self.max_age = max_age  # Seconds to reuse rendered programme for
+        self.entries = {}  # Of the last run
+        self.new_entries = {}  # Of the current run
+        self.started_at = int(time.time())
+
+        if self.filepath.exists():
+            try:
+                with gzip.open(self.filepath, 'rt', encoding='utf-8') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+
+            if state.get('settings') == self.settings:
+                self.entries = state['entries']
+
+    @staticmethod
+    def make_key(channel_id, program_id, start_timestamp):
+        return f'{channel_id}|{program_id}|{start_timestamp}'
+
+    def get(self, key, source_fingerprint):
+        """Get entry rendered from the same source, unless it's too old."""
+        entry = self.entries.get(key)
+        if entry and entry['fingerprint'] == source_fingerprint \
+                and entry['rendered_at'] >= self.started_at - self.max_age:
+            return entry
+
+        return None
+
+    def put(self, key, source_fingerprint, fragment, end_timestamp, posters, tags,
+            rendered_at=None):
+        self.new_entries[key] = {
+            'fingerprint': source_fingerprint,
+            'fragment': fragment,
+            'end_timestamp': end_timestamp,
+            'posters': posters,
+            'tags': tags,
+            'rendered_at': rendered_at or self.started_at,
+        }
+
+    def save(self):
+        """Save entries of the current run, except ended programmes."""
+        entries = {key: entry for key, entry in self.new_entries.items()
+                   if entry['end_timestamp'] > self.started_at}
+
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_filepath = self.filepath.with_name(self.filepath.name + '.tmp')
+        with gzip.open(tmp_filepath, 'wt', encoding='utf-8') as f:
+            json.dump({'settings': self.settings, 'entries': entries}, f)
+        os.replace(tmp_filepath, self.filepath)
+
+        # The next run in the same process starts from this one
+        self.entries, self.new_entries = entries, {}
+        self.started_at = int(time.time())
@@ -0,0 +1,307 @@
+import asyncio
+import collections
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from epg_cache import EMPTY, CacheEntry
+from epg_metrics import count
+
+# Keys per query of bulk reads, below SQLite limit of variables
+BULK_SIZE = 500
+
+# Store made with other schema version is dropped
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB,
+    fresh_until REAL NOT NULL,
+    expire_at REAL NOT NULL,
+    validators TEXT,
+    stored_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_expire_at ON entries (expire_at);
+CREATE INDEX IF NOT EXISTS entries_stored_at ON entries (stored_at);
+'''
+
+
+def encode_json(value):
+    """Compressed JSON of trimmed payload."""
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_json(blob):
+    return json.loads(zlib.decompress(blob))
+
+
+CODECS = {
+    'details': (encode_json, decode_json),
+    'cast': (encode_json, decode_json),
+}
+
+NAMESPACES = tuple(CODECS)
+
+
+def count_hit(entry, tier):
+    """Count hit of fresh non-empty entry found in `tier`, pass entry on."""
+    if isinstance(entry, CacheEntry) and entry.value is not EMPTY and entry.fresh_until > time.time():
+        count(f'cache_{tier}_hits')
+    return entry
+
+
+class CompactStore:
+    """SQLite store of downloaded results, split into namespaces.
+
+    Unlike pickles of `DISK_CACHE`, metadata is kept as trimmed raw JSON,
+    compressed, so it survives model changes. Resized posters are not kept,
+    the poster store has them. Entries are `CacheEntry`, empty results
+    are stored as `EMPTY`. The store could be used from other threads.
+    Write-ahead log is merged into the file on close, so the file alone
+    carries the store over to the next run, e.g. committed by CI.
+    """
+
+    def __init__(self, filepath):
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(filepath), isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS entries')
+            self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self.db.executescript(SCHEMA)
+        # Namespaces dropped since
+        self.db.execute('DELETE FROM entries WHERE namespace NOT IN (%s)' % ','.join('?' * len(CODECS)),
+                        NAMESPACES)
+
+    def decode(self, namespace, row):
+        blob, fresh_until, validators = row
+        value = EMPTY if blob is None else CODECS[namespace][1](blob)
+        return CacheEntry(value, fresh_until, json.loads(validators) if validators else None)
+
+    def get(self, namespace, key):
+        """Get entry, unless it's expired."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT value, fresh_until, validators FROM entries '
+                'WHERE namespace = ? AND key = ? AND expire_at > ?',
+                (namespace, key, time.time())
+            ).fetchone()
+        return self.decode(namespace, row) if row else None
+
+    def get_many(self, namespace, keys):
+        """Get entries of many keys at once, returns them by key."""
+        keys = list(keys)
+        entries = {}
+        for i in range(0, len(keys), BULK_SIZE):
+            bulk = keys[i:i + BULK_SIZE]
+            with self.lock:
+                rows = self.db.execute(
+                    'SELECT key, value, fresh_until, validators FROM entries '
+                    'WHERE namespace = ? AND expire_at > ? AND key IN (%s)' % ','.join('?' * len(bulk)),
+                    (namespace, time.time(), *bulk)
+                ).fetchall()
+            for key, *row in rows:
+                entries[key] = self.decode(namespace, row)
+
+        return entries
+
+    def set(self, namespace, key, entry, expire):
+        """Store entry for `expire` seconds."""
+        self.set_many([(namespace, key, entry, expire)])
+
+    def set_many(self, items):
+        """Store `(namespace, key, entry, expire)` items in one transaction."""
+        now = time.time()
+        rows = [
+            (namespace, key, None if entry.value is EMPTY else CODECS[namespace][0](entry.value),
+             entry.fresh_until, now + expire,
+             json.dumps(entry.validators) if entry.validators else None, now)
+            for namespace, key, entry, expire in items
+        ]
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def delete(self, where, args, limit=None):
+        """Remove entries matching `where` clause, at most `limit` of them,
+        returns their number."""
+        if limit is not None:
+            where = ('(namespace, key) IN (SELECT namespace, key FROM entries '
+                     'WHERE %s LIMIT %d)' % (where, limit))
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            return self.db.execute('DELETE FROM entries WHERE ' + where, args).rowcount
+
+    def expire(self, limit=None):
+        """Remove expired entries, at most `limit` of them, returns their number."""
+        return self.delete('expire_at <= ?', (time.time(),), limit)
+
+    def prune(self, older_than):
+        """Remove entries stored more than `older_than` seconds ago."""
+        return self.delete('stored_at < ?', (time.time() - older_than,))
+
+    def evict(self, namespace):
+        """Remove all entries of namespace."""
+        return self.delete('namespace = ?', (namespace,))
+
+    def vacuum(self):
+        """Give space of removed entries back to the file system."""
+        with self.lock:
+            self.db.execute('VACUUM')
+
+    def file_size(self):
+        """Size of the store file in bytes."""
+        with self.lock:
+            page_count = self.db.execute('PRAGMA page_count').fetchone()[0]
+            page_size = self.db.execute('PRAGMA page_size').fetchone()[0]
+        return page_count * page_size
+
+    def stats(self):
+        """Number of entries and their size in bytes, per namespace."""
+        stats = {namespace: {'entries': 0, 'bytes': 0} for namespace in NAMESPACES}
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT namespace, COUNT(*), COALESCE(SUM(LENGTH(value)), 0) '
+                'FROM entries GROUP BY namespace'
+            ).fetchall()
+        for namespace, entries, size in rows:
+            stats[namespace] = {'entries': entries, 'bytes': size}
+
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.db.close()
+
+
+class StoreCache:
+    """In-memory LRU in front of the compact store.
+
+    Keys are loaded and decoded in bulk by `prefetch`, keys not prefetched
+    are looked up one by one, both in a thread, so the store is never queried
+    on the event loop. Hits of fresh entries are counted by where they come
+    from, memory or disk. Keys missing from the store are remembered as `None`.
+    Entries are shared by lookups, they are not to be modified. Only entries
+    of `namespaces` are kept in memory, writes of all are buffered and stored
+    at once by `write_back` at the end of stages, in the thread as well.
+    """
+
+    def __init__(self, store, namespaces, max_entries=10000):
+        self.store = store
+        self.namespaces = namespaces
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # By namespace and key
+        self.loading = {}  # Futures of bulk reads by namespace and key
+        self.pending = {}  # Writes by namespace and key, entries with expire seconds
+        self.writing = {}  # Writes being stored by `write_back`
+        self.executor = ThreadPoolExecutor(max_workers=1)  # Queries go one by one anyway
+
+    def remember(self, item, entry):
+        self.entries[item] = entry
+        self.entries.move_to_end(item)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def prefetch(self, namespace, keys):
+        """Start loading keys not known yet, returns future of the bulk read."""
+        keys = [key for key in dict.fromkeys(keys)
+                if (namespace, key) not in self.entries and (namespace, key) not in self.loading
+                and (namespace, key) not in self.pending and (namespace, key) not in self.writing]
+        if not keys:
+            return None
+
+        started_at = time.perf_counter()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.store.get_many, namespace, keys
+        )
+        for key in keys:
+            self.loading[(namespace, key)] = future
+
+        def done(future):
+            count('cache_prefetched', len(keys))
+            count('cache_prefetch_seconds', time.perf_counter() - started_at)
+            for key in keys:
+                self.loading.pop((namespace, key), None)
+            if future.cancelled() or future.exception():
+                return
+
+            entries = future.result()
+            for key in keys:
+                self.remember((namespace, key), entries.get(key))
+
+        future.add_done_callback(done)
+        return future
+
+    async def get(self, namespace, key):
+        """Get entry, waiting for its bulk read if it's in flight."""
+        item = (namespace, key)
+        write = self.pending.get(item) or self.writing.get(item)
+        if write:
+            return count_hit(write[0], 'memory')
+
+        future = self.loading.get(item)
+        if future:
+            try:
+                await asyncio.shield(future)
+            except Exception:
+                pass  # Looked up on the spot then
+
+        if item in self.entries:
+            self.entries.move_to_end(item)
+            return count_hit(self.entries[item], 'disk' if future else 'memory')
+
+        # Not prefetched, look it up on the spot
+        started_at = time.perf_counter()
+        entry = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.store.get, namespace, key
+        )
+        count('cache_lookup_seconds', time.perf_counter() - started_at)
+        if namespace in self.namespaces:
+            self.remember(item, entry)
+        return count_hit(entry, 'disk')
+
+    def set(self, namespace, key, entry, expire):
+        """Buffer entry stored for `expire` seconds."""
+        item = (namespace, key)
+        self.pending[item] = (entry, expire)
+        self.entries.pop(item, None)
+
+    async def write_back(self):
+        """Store buffered entries in one transaction, in the thread."""
+        if not self.pending:
+            return
+
+        self.writing, self.pending = self.pending, {}
+        started_at = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.store.set_many,
+                [(namespace, key, entry, expire)
+                 for (namespace, key), (entry, expire) in self.writing.items()]
+            )
+        except BaseException:
+            self.pending = {**self.writing, **self.pending}  # Stored by the next one
+            raise
+        finally:
+            self.writing = {}
+            count('cache_flush_seconds', time.perf_counter() - started_at)
+
+    def flush(self):
+        """Store buffered entries in one transaction, e.g. on exit."""
+        if not self.pending:
+            return
+
+        started_at = time.perf_counter()
+        self.store.set_many([(namespace, key, entry, expire)
+                             for (namespace, key), (entry, expire) in self.pending.items()])
+        self.pending = {}
+        count('cache_flush_seconds', time.perf_counter() - started_at)
@@ -0,0 +1,366 @@
+import dataclasses
+import enum
+import gzip
+import heapq
+import json
+import mmap
+import os
+import pathlib
+import time
+from array import array
+from datetime import datetime
+from functools import lru_cache
+from typing import NamedTuple
+
+import lxml.etree as ET
+
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+SCHEMA_LOCATION = f'{{{XSI_NS}}}schemaLocation'
+INDENT = '  '
+TIME_FORMAT = '%Y%m%d%H%M%S %z'
+
+# Index made with other version is not read
+INDEX_VERSION = 1
+
+
+@lru_cache(maxsize=None)
+def dataclass_fields(cls):
+    """XML name and type of every field of xsdata dataclass."""
+    return [
+        (field.name, field.metadata.get('name', field.name), field.metadata.get('type', 'Text'))
+        for field in dataclasses.fields(cls)
+    ]
+
+
+def element_name(obj):
+    """XML name of xsdata dataclass."""
+    meta = getattr(type(obj), 'Meta', None)
+    return getattr(meta, 'name', type(obj).__name__)
+
+
+def text_value(value):
+    """Convert simple value to XML text."""
+    if isinstance(value, enum.Enum):
+        value = value.value
+
+    return str(value)
+
+
+def add_text(element, text):
+    """Append text to element content."""
+    if len(element):
+        element[-1].tail = (element[-1].tail or '') + text
+    else:
+        element.text = (element.text or '') + text
+
+
+def to_element(obj, name=None):
+    """Convert xsdata dataclass or simple value to lxml element.
+
+    Unlike xsdata serializer it never puts `xsi:type`
+    for subclassed models, e.g. `models.xmltv.Programme`.
+    """
+    element = ET.Element(name or element_name(obj))
+    if not dataclasses.is_dataclass(obj):
+        if obj != '':
+            element.text = text_value(obj)
+        return element
+
+    for attr_name, xml_name, xml_type in dataclass_fields(type(obj)):
+        value = getattr(obj, attr_name)
+        if value is None or value == []:
+            continue
+
+        if xml_type == 'Attribute':
+            element.set(xml_name, text_value(value))
+        elif xml_type == 'Element':
+            for item in value if isinstance(value, list) else [value]:
+                element.append(to_element(item, xml_name))
+        else:  # Text and mixed content
+            for item in value if isinstance(value, list) else [value]:
+                if dataclasses.is_dataclass(item):
+                    element.append(to_element(item))
+                else:
+                    add_text(element, text_value(item))
+
+    return element
+
+
+def render_element(obj):
+    """Render xsdata dataclass as pretty printed child of `<tv>`."""
+    element = to_element(obj)
+    ET.indent(element, space=INDENT, level=1)
+    return INDENT.encode() + ET.tostring(element, encoding='UTF-8') + b'\n'
+
+
+def parse_time(value):
+    """Timestamp of XMLTV time, None if there's none."""
+    return int(datetime.strptime(value, TIME_FORMAT).timestamp()) if value else None
+
+
+def index_filepath(filepath):
+    """Path of sidecar index of XMLTV document."""
+    return filepath.with_name(filepath.name + '.index.json')
+
+
+class XmltvWriter:
+    """Incremental XMLTV document writer.
+
+    Rendered channels and programmes are written as soon as they are
+    produced, gzip archive is written in the same pass. Byte ranges
+    and time spans of programmes are kept in sidecar index, by channel,
+    see `XmltvReader`. Files are replaced atomically once the document
+    is complete, the document first.
+    """
+
+    def __init__(self, filepath, create_archive=False, schema_location=None, **tv_attrs):
+        self.filepath = filepath
+        self.archive_filepath = filepath.with_name(filepath.name + '.gz') if create_archive else None
+        self.filepaths = [filepath]
+        if create_archive:
+            self.filepaths.append(self.archive_filepath)
+        self.filepaths.append(index_filepath(filepath))
+
+        self.schema_location = schema_location
+        self.tv_attrs = tv_attrs
+        self.files = []  # Targets of written data
+        self.raw_files = []
+        self.offset = 0  # Bytes written to the document
+        self.index = {}  # Offset, length, start and stop of programmes by channel ID
+
+    def __enter__(self):
+        self.raw_files = [tmp_filepath.open('wb') for tmp_filepath in self.tmp_filepaths[:-1]]
+        self.files = [self.raw_files[0]]
+        if len(self.raw_files) > 1:
+            # Name the archived file as the document, not as the temporary file
+            self.files.append(gzip.GzipFile(self.filepath.name, mode='wb',
+                                            fileobj=self.raw_files[1]))
+
+        tv = ET.Element('tv', nsmap={'xsi': XSI_NS})
+        if self.schema_location:
+            tv.set(SCHEMA_LOCATION, self.schema_location)
+        for name, value in self.tv_attrs.items():
+            if value is not None:
+                tv.set(name.replace('_', '-'), value)
+
+        # Opening tag only
+        tv_open = ET.tostring(tv, encoding='UTF-8')[:-2] + b'>\n'
+        self.write(b"<?xml version='1.0' encoding='UTF-8'?>\n" + tv_open)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.write(b'</tv>\n')
+
+        for file in self.files[1:] + self.raw_files:
+            file.close()
+
+        if exc_type is None:
+            self.save_index(self.tmp_filepaths[-1])
+
+        for tmp_filepath, filepath in zip(self.tmp_filepaths, self.filepaths):
+            if exc_type is None:
+                os.replace(tmp_filepath, filepath)
+            else:
+                tmp_filepath.unlink(missing_ok=True)
+
+    @property
+    def tmp_filepaths(self):
+        return [filepath.with_name(filepath.name + '.tmp') for filepath in self.filepaths]
+
+    def write(self, data):
+        """Write rendered data to the document and its archive."""
+        for file in self.files:
+            file.write(data)
+        self.offset += len(data)
+
+    def write_programme(self, data, channel_id, start, stop):
+        """Write rendered programme of channel airing from `start` till `stop`
+        (timestamps) and index it. Programmes of every channel are expected
+        to be written one after another, in order of start."""
+        self.index.setdefault(channel_id, array('q')).extend((self.offset, len(data), start, stop))
+        self.write(data)
+
+    def save_index(self, filepath):
+        """Save index channel by channel: time span of its programmes, byte
+        ranges of the document they take and `[offset, length, start, stop]`
+        of every one of them."""
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.write('{"version":%d,"size":%d,"channels":{' % (INDEX_VERSION, self.offset))
+            for idx, (channel_id, entries) in enumerate(self.index.items()):
+                programmes = [entries[i:i + 4].tolist() for i in range(0, len(entries), 4)]
+                ranges = []
+                for offset, length, _, _ in programmes:
+                    if ranges and sum(ranges[-1]) == offset:
+                        ranges[-1][1] += length
+                    else:
+                        ranges.append([offset, length])
+
+                entry = {
+                    'start': min(programme[2] for programme in programmes),
+                    'stop': max(programme[3] for programme in programmes),
+                    'ranges': ranges,
+                    'programmes': programmes,
+                }
+                f.write('%s%s:%s' % (',' if idx else '', json.dumps(channel_id),
+                                     json.dumps(entry, separators=(',', ':'))))
+            f.write('}}\n')
+
+
+class XmltvReader:
+    """Random access to programmes of XMLTV document by its sidecar index.
+
+    The document is mapped into memory, only programmes asked for are
+    read from it, without parsing the rest. Programmes come as rendered,
+    `lxml.etree.fromstring` parses them. Timestamps are seconds since epoch.
+    """
+
+    def __init__(self, filepath):
+        filepath = pathlib.Path(filepath)
+        self.index = json.loads(index_filepath(filepath).read_text(encoding='utf-8'))
+        self.file = filepath.open('rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.index.get('version') != INDEX_VERSION or self.index['size'] != len(self.mmap):
+            self.close()
+            raise ValueError(f'Index of {filepath} does not match the document')
+
+        self.channels = self.index['channels']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+    def span(self, channel_id):
+        """Start of the first programme of channel and stop of the last one."""
+        entry = self.channels[channel_id]
+        return entry['start'], entry['stop']
+
+    def channel(self, channel_id):
+        """All programmes of channel, as a slice of the document."""
+        entry = self.channels.get(channel_id)
+        if not entry:
+            return b''
+
+        return b''.join(self.mmap[offset:offset + length] for offset, length in entry['ranges'])
+
+    def programmes(self, start, stop, channel_ids=None):
+        """Programmes overlapping time window from `start` till `stop`,
+        of every channel or of `channel_ids`, as channel ID and programme."""
+        for channel_id in channel_ids if channel_ids is not None else self.channels:
+            entry = self.channels.get(channel_id)
+            if not entry or entry['stop'] <= start or entry['start'] >= stop:
+                continue
+
+            for offset, length, programme_start, programme_stop in entry['programmes']:
+                if programme_start >= stop:
+                    break  # The rest start later
+                if programme_stop > start:
+                    yield channel_id, self.mmap[offset:offset + length]
+
+    def now_next(self, channel_id, at=None):
+        """Programme of channel airing `at` (now by default) and the next one."""
+        at = time.time() if at is None else at
+        entry = self.channels.get(channel_id)
+        programmes = entry['programmes'] if entry else []
+        for idx, (_, _, _, programme_stop) in enumerate(programmes):
+            if programme_stop > at:
+                return [self.mmap[offset:offset + length]
+                        for offset, length, _, _ in programmes[idx:idx + 2]]
+
+        return []
+
+
+class MergeResult(NamedTuple):
+    channel_ids: list  # Of merged channels, in order
+    programmes: int
+    duplicates: int  # Elements of channels merged from another document
+
+
+def iter_children(filepath):
+    """Stream `<tv>` element of XMLTV document and its children one by one.
+
+    Yields the root element first, with its attributes only, then every
+    child detached from the document, so the document is never kept
+    in memory as a whole.
+    """
+    root = None
+    depth = 0
+    for event, element in ET.iterparse(str(filepath), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = element
+                yield root
+            continue
+
+        depth -= 1
+        if depth == 1:
+            root.remove(element)
+            ET.cleanup_namespaces(element)  # Declared by the root only
+            yield element
+
+
+def render_parsed_element(element):
+    """Render child of `<tv>` parsed from document as it was rendered."""
+    return INDENT.encode() + ET.tostring(element, encoding='UTF-8', with_tail=False) + b'\n'
+
+
+def merge_documents(filepath, shard_filepaths, channel_ids=(), create_archive=False):
+    """Merge XMLTV documents of shards into one, streaming them.
+
+    Channels go first, then programmes, both in order of `channel_ids`,
+    channels missing there go after them by ID, programmes of every channel
+    go by start. Documents are expected to be ordered the same way, as made
+    by `XmltvWriter` of shards, so they are merged k-way. Channel found
+    in several documents is taken from the first of them. Attributes of `<tv>`
+    are taken from the first document as well.
+    """
+    order = {channel_id: idx for idx, channel_id in enumerate(channel_ids)}
+
+    def sort_key(item):
+        _, element = item
+        if element.tag == 'channel':
+            rank, channel_id, start = 0, element.get('id'), ''
+        else:
+            rank, channel_id, start = 1, element.get('channel'), element.get('start')
+        return rank, order.get(channel_id, len(order)), channel_id or '', start or ''
+
+    def indexed(shard_idx, children):
+        for element in children:
+            yield shard_idx, element
+
+    shards = [iter_children(shard_filepath) for shard_filepath in shard_filepaths]
+    roots = [next(shard) for shard in shards]
+    tv_attrs = {name: value for name, value in roots[0].attrib.items() if name != SCHEMA_LOCATION}
+
+    owners = {}  # Documents of channels by channel ID
+    programmes = duplicates = 0
+    with XmltvWriter(filepath, create_archive, schema_location=roots[0].get(SCHEMA_LOCATION),
+                     **tv_attrs) as writer:
+        merged = heapq.merge(*[indexed(idx, shard) for idx, shard in enumerate(shards)],
+                             key=sort_key)
+        for shard_idx, element in merged:
+            if element.tag == 'channel':
+                owner = owners.setdefault(element.get('id'), shard_idx)
+            else:
+                owner = owners.get(element.get('channel'), shard_idx)
+                programmes += owner == shard_idx
+
+            if owner != shard_idx:
+                duplicates += 1
+                continue
+
+            data = render_parsed_element(element)
+            if element.tag == 'channel':
+                writer.write(data)
+            else:
+                writer.write_programme(data, element.get('channel'), parse_time(element.get('start')),
+                                       parse_time(element.get('stop')))
+
+    return MergeResult(list(owners), programmes, duplicates)
@@ -1,8 +1,10 @@
-from .program_details import ProgramDetails
-from .shows_cast import ShowsCast
+from .program_details import LeanProgramDetails, ProgramDetails
+from .shows_cast import LeanShowsCast, ShowsCast
 
 
 __all__ = [
+    'LeanProgramDetails',
+    'LeanShowsCast',
     'ProgramDetails',
     'ShowsCast',
 ]
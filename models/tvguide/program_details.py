@@ -3,6 +3,7 @@ from __future__ import annotations
 import re
 import warnings
 from datetime import datetime
+from functools import lru_cache
 from typing import List, Optional
 
 from pydantic import BaseModel, validator
@@ -11,22 +12,42 @@ from xmltv.models import (Category, EpisodeNum, Icon, Length, Rating,
 
 from ..xmltv import Programme
 
+NON_DIGITS_RE = re.compile(r'[^\d]')
+GENRE_WORDS_RE = re.compile(r'[\w\s-]+&?\s?')
 
-class ImageType(BaseModel):
-    typeId: int
-    typeName: str  # "showcard", "key art"
-    providerTypeName: str
 
+@lru_cache(maxsize=None)
+def recase_genre(genre):
+    """All subgenres are lowercased, recase it."""
+    return GENRE_WORDS_RE.sub(lambda x: x.group(0).capitalize(), genre)
 
-class Image(BaseModel):
-    id: str
-    provider: str
-    imageType: ImageType
-    bucketType: str
-    bucketPath: str
-    filename: str
-    width: int
-    height: int
+
+@lru_cache(maxsize=4096)
+def xmltv_date(episode_air_date):
+    """XMLTV date of "/Date(timestamp + timezone offset)/", None if it's invalid."""
+    try:
+        ts = int(NON_DIGITS_RE.sub('', episode_air_date)[:-3])  # tz comes always "000"
+        return datetime.fromtimestamp(ts).strftime('%Y%m%d')
+    except ValueError:
+        return None
+
+
+class Lean:
+    """Lean model of data validated already, e.g. read back from our own
+    cache, made without validation. Only fields of `__slots__` are kept."""
+    __slots__ = ()
+
+    def __init__(self, data):
+        for name in self.__slots__:
+            setattr(self, name, data.get(name))
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+class ImageUrl:
+    __slots__ = ()
 
     @property
     def url(self) -> str:
@@ -37,76 +58,45 @@ class Image(BaseModel):
                     + self.bucketPath.lstrip('/')
 
 
+# Fields XMLTV output doesn't need are left out of models below
+class Image(ImageUrl, BaseModel):
+    # id: str
+    # provider: str
+    # imageType: ImageType
+    bucketType: str
+    bucketPath: str
+    # filename: str
+    width: int
+    height: int
+
+
+class LeanImage(ImageUrl, Lean):
+    __slots__ = tuple(Image.__fields__)
+
+
 class Genre(BaseModel):
     id: int
     name: str
     genres: List[str]
 
 
-class MetacriticSummaryItem(BaseModel):
-    url: Optional[str]
-    score: int
-    reviewCount: int
+class LeanGenre(Lean):
+    __slots__ = tuple(Genre.__fields__)
 
 
-class VideoImage(BaseModel):
-    imageUrl: str
-    width: int
-    height: int
+class MetacriticSummaryItem(BaseModel):
+    # url: Optional[str]
+    score: int
+    # reviewCount: int
 
 
-class VideoItem(BaseModel):
-    videoId: int
-    providerId: int
-    title: str
-    slug: str
-    type: str
-    contentType: str
-    contentTypeId: int
-    videoTitle: str
-    url: str
-    # description: Optional[str]
-    duration: int
-    originalAirDate: Optional[str]
-    seasonNumber: int
-    episodeNumber: int
-    images: List[VideoImage]
-
-
-class ProgramDetails(BaseModel):
-    id: int
-    name: str
-    parentId: Optional[int]
-    description: Optional[str]
-    isSportsEvent: bool
-    rating: Optional[str]
-    tvRating: Optional[str]
-    episodeTitle: Optional[str]
-    releaseYear: Optional[int]
-    # seoUrl: Optional[str]
-    categoryId: int
-    subCategoryId: int
-    episodeAirDate: Optional[str]  # /Date(timestamp + timezone offset)/
-    episodeNumber: Optional[int]
-    seasonNumber: Optional[int]
-    mcoId: Optional[int]
-    title: Optional[str]
-    type: Optional[str]
-    slug: Optional[str]
-    typeId: Optional[int]
-    images: List[Image]
-    genres: List[Genre]
-    duration: Optional[int]  # Seconds
-    metacriticSummary: Optional[MetacriticSummaryItem]
-    video: Optional[VideoItem]
+class LeanMetacriticSummaryItem(Lean):
+    __slots__ = tuple(MetacriticSummaryItem.__fields__)
 
-    @validator('tvRating')
-    def uppercase_tv_rating(cls, v):
-        """Just to be sure TV rating is always uppercased."""
-        if v is not None:
-            v = v.upper()
 
-        return v
+class ProgramDetailsConversion:
+    """Conversion of program details to XMLTV."""
+    __slots__ = ()
 
     @property
     def rating_system(self):
@@ -139,28 +129,19 @@ class ProgramDetails(BaseModel):
 
         # Date
         if self.episodeAirDate:
-            try:
-                ts = int(re.sub(r'[^\d]', '', self.episodeAirDate)[:-3])  # tz comes always "000"
-                date = datetime.fromtimestamp(ts)
-                program.date = date.strftime('%Y%m%d')
-            except ValueError:
-                pass
+            program.date = xmltv_date(self.episodeAirDate)
 
         if not program.date and self.releaseYear:
             # Add trailing zeros, eg: <date>20070000</date>
             program.date = f'{self.releaseYear}0000'
 
         # Genres
-        for genre in sorted(self.genres, key=lambda x: x.id):
+        genres = self.genres if len(self.genres) < 2 else sorted(self.genres, key=lambda x: x.id)
+        for genre in genres:
             if expand_genres:
                 for sub_genre in genre.genres:
-                    # All subgenres are lowercased, recase it
-                    sub_genre = re.sub(
-                        r'[\w\s-]+&?\s?', lambda x: x.group(0).capitalize(),
-                        sub_genre
-                    )
                     program.category.append(
-                        Category(content=[sub_genre])
+                        Category(content=[recase_genre(sub_genre)])
                     )
             else:
                 program.category.append(Category(
@@ -247,3 +228,50 @@ class ProgramDetails(BaseModel):
             program.star_rating.append(star_rating)
 
         return program
+
+
+class ProgramDetails(ProgramDetailsConversion, BaseModel):
+    id: int
+    name: str
+    # parentId: Optional[int]
+    description: Optional[str]
+    # isSportsEvent: bool
+    # rating: Optional[str]
+    tvRating: Optional[str]
+    episodeTitle: Optional[str]
+    releaseYear: Optional[int]
+    # seoUrl: Optional[str]
+    # categoryId: int
+    # subCategoryId: int
+    episodeAirDate: Optional[str]  # /Date(timestamp + timezone offset)/
+    episodeNumber: Optional[int]
+    seasonNumber: Optional[int]
+    mcoId: Optional[int]
+    # title: Optional[str]
+    # type: Optional[str]
+    # slug: Optional[str]
+    # typeId: Optional[int]
+    images: List[Image]
+    genres: List[Genre]
+    duration: Optional[int]  # Seconds
+    metacriticSummary: Optional[MetacriticSummaryItem]
+    # video: Optional[VideoItem]
+
+    @validator('tvRating')
+    def uppercase_tv_rating(cls, v):
+        """Just to be sure TV rating is always uppercased."""
+        if v is not None:
+            v = v.upper()
+
+        return v
+
+
+class LeanProgramDetails(ProgramDetailsConversion, Lean):
+    __slots__ = tuple(ProgramDetails.__fields__)
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.images = [LeanImage(image) for image in self.images]
+        self.genres = [LeanGenre(genre) for genre in self.genres]
+        if self.metacriticSummary:
+            self.metacriticSummary = LeanMetacriticSummaryItem(self.metacriticSummary)
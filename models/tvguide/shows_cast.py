@@ -5,6 +5,8 @@ from typing import List, Optional
 from pydantic import BaseModel, NonNegativeInt
 from xmltv.models import Credits, Actor
 
+from .program_details import Lean
+
 
 # class Image(BaseModel):
 #     id: str
@@ -22,6 +24,10 @@ class Item(BaseModel):
     # image: Optional[Image] = None
 
 
+class LeanItem(Lean):
+    __slots__ = tuple(Item.__fields__)
+
+
 class ShowsCastXMLTVOptions(BaseModel):
     """Options purposed to control number of cast
     per type presented in target xmltv credits."""
@@ -36,21 +42,14 @@ class ShowsCastXMLTVOptions(BaseModel):
     commentator: NonNegativeInt = 2
     guest: NonNegativeInt = 3
 
-    def take_one(self, type_name):
-        if not hasattr(self, type_name):
-            return False
 
-        allowed_positions = getattr(self, type_name)
-        if allowed_positions > 0:
-            setattr(self, type_name, allowed_positions - 1)
-            return True
+# Number of cast per type in XMLTV credits, by default
+CAST_LIMITS = ShowsCastXMLTVOptions().dict()
 
-        return False
 
-
-class ShowsCast(BaseModel):
-    id: str
-    items: List[Item]
+class ShowsCastConversion:
+    """Conversion of cast to XMLTV credits."""
+    __slots__ = ()
 
     def add_cast(self, xmltv_program, **options):
         """Add cast & crew to xmltv program.
@@ -59,11 +58,12 @@ class ShowsCast(BaseModel):
             add_cast(xmltv_program, actor=99, director=1, adapter=0)
         """
         staff_list = []
-        xmltv_options = ShowsCastXMLTVOptions(**options)
+        limits = ShowsCastXMLTVOptions(**options).dict() if options else dict(CAST_LIMITS)
 
         for person in self.items:
             type_name = person.type.lower()
-            if xmltv_options.take_one(type_name):
+            if limits.get(type_name, 0) > 0:
+                limits[type_name] -= 1
                 staff_list.append((type_name, person.name, person.role))
 
         if staff_list:
@@ -75,3 +75,16 @@ class ShowsCast(BaseModel):
                     credits.actor = Actor(content=[person_name], role=person_role)
 
             xmltv_program.credits = credits
+
+
+class ShowsCast(ShowsCastConversion, BaseModel):
+    id: str
+    items: List[Item]
+
+
+class LeanShowsCast(ShowsCastConversion, Lean):
+    __slots__ = tuple(ShowsCast.__fields__)
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.items = [LeanItem(item) for item in self.items]
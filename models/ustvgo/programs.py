@@ -1,10 +1,6 @@
 from __future__ import annotations
 
-from typing import Optional, List
-
-from pydantic import BaseModel, PrivateAttr
-
-from ..tvguide import ProgramDetails, ShowsCast
+from pydantic import BaseModel
 
 
 class Program(BaseModel):
@@ -18,7 +14,4 @@ class Program(BaseModel):
     day: str
     start_time: str
     end_time: str
-    tags: List[str] = []
-
-    _details: Optional[ProgramDetails] = PrivateAttr(default=None)
-    _cast: Optional[ShowsCast] = PrivateAttr(default=None)
+    # tags: List[str] = []
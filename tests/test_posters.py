@@ -0,0 +1,111 @@
+import json
+import os
+
+import pytest
+
+from epg_posters import PosterStore
+
+GRACE_PERIOD = 100
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PosterStore(tmp_path, grace_period=GRACE_PERIOD)
+
+
+def age(filepath, seconds):
+    """Make file look modified `seconds` ago."""
+    mtime = filepath.stat().st_mtime - seconds
+    os.utime(filepath, (mtime, mtime))
+
+
+def put(store, name, last_used_ago=0, modified_ago=GRACE_PERIOD * 2):
+    """Store poster used `last_used_ago` seconds ago, return its file."""
+    key = store.make_key(f'/{name}.jpg', 720, 80)
+    entry = store.put(key, b'poster', 720, 405, '.jpg')
+    entry['last_used'] -= last_used_ago
+    filepath = store.root / entry['path']
+    age(filepath, modified_ago)
+    return filepath
+
+
+def write_manifest(store, name, entries):
+    filepath = store.root / name
+    filepath.write_text(json.dumps(entries), encoding='utf-8')
+    age(filepath, GRACE_PERIOD * 2)
+    return filepath
+
+
+def test_referenced_posters_kept(store):
+    used = put(store, 'used')
+    expired = put(store, 'expired', last_used_ago=GRACE_PERIOD * 2)
+
+    assert store.collect_garbage() == 1
+    assert used.exists()
+    assert not expired.exists()
+    assert list(store.manifest.values()) == [
+        {'path': used.relative_to(store.root).as_posix(), 'width': 720, 'height': 405,
+         'last_used': store.started_at}
+    ]
+
+
+def test_unreferenced_posters_kept_for_grace_period(store):
+    fresh = put(store, 'fresh', modified_ago=0)
+    old = put(store, 'old')
+    store.manifest.clear()
+
+    assert store.collect_garbage() == 1
+    assert fresh.exists()
+    assert not old.exists()
+
+
+def test_posters_of_other_manifests_kept(store):
+    shared = put(store, 'shared')
+    expired = put(store, 'expired')
+    other = {
+        store.make_key('/shared.jpg', 720, 80): {'path': shared.relative_to(store.root).as_posix(),
+                                                 'last_used': store.started_at},
+        store.make_key('/expired.jpg', 720, 80): {'path': expired.relative_to(store.root).as_posix(),
+                                                  'last_used': store.started_at - GRACE_PERIOD * 2},
+    }
+    store.manifest.clear()
+    manifest = write_manifest(store, 'manifest.2-of-2.json', other)
+    store.save()
+    age(store.manifest_path, GRACE_PERIOD * 2)
+
+    assert store.collect_garbage() == 1
+    assert shared.exists()
+    assert not expired.exists()
+    assert manifest.exists() and store.manifest_path.exists()
+
+
+def test_unreadable_manifest_removes_nothing(store):
+    orphan = put(store, 'orphan')
+    store.manifest.clear()
+    (store.root / 'manifest.2-of-2.json').write_text('{', encoding='utf-8')
+
+    assert store.collect_garbage() == 0
+    assert orphan.exists()
+
+
+def test_poster_reused_across_stores(tmp_path):
+    store = PosterStore(tmp_path, grace_period=GRACE_PERIOD)
+    put(store, 'poster')
+    store.save()
+
+    reopened = PosterStore(tmp_path, grace_period=GRACE_PERIOD)
+    entry = reopened.get(store.make_key('/poster.jpg', 720, 80))
+    assert entry and entry['last_used'] == reopened.started_at
+    assert reopened.get(store.make_key('/missing.jpg', 720, 80)) is None
+
+
+def test_save_moves_clock(store, monkeypatch):
+    started_at = store.started_at
+    monkeypatch.setattr('time.time', lambda: started_at + GRACE_PERIOD * 2)
+    store.save()
+
+    # Posters not referenced since the last refresh expire
+    assert store.started_at == started_at + GRACE_PERIOD * 2
+    expired = put(store, 'expired', last_used_ago=GRACE_PERIOD * 2)
+    assert store.collect_garbage() == 1
+    assert not expired.exists()
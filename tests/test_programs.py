@@ -0,0 +1,61 @@
+import pytest
+
+import models.tvguide
+from epg_programs import ProgramStores, ProgramTable
+
+PROGRAM_ID = 42
+MCO_ID = 7
+FINGERPRINT = '00' * 20
+
+
+def details(mco_id=MCO_ID, images=1):
+    return models.tvguide.LeanProgramDetails({
+        'id': PROGRAM_ID, 'name': 'Show', 'mcoId': mco_id, 'genres': [],
+        'images': [{'bucketType': 'tvguide', 'bucketPath': f'/poster{idx}.jpg', 'width': 1, 'height': 1}
+                   for idx in range(images)],
+    })
+
+
+@pytest.fixture
+def airings():
+    """Two airings of the same program on two channels."""
+    stores = ProgramStores()
+    first, second = ProgramTable(stores), ProgramTable(stores)
+    first.append(PROGRAM_ID, 'Show', 0, 1800, FINGERPRINT)
+    second.append(PROGRAM_ID, 'Show', 3600, 5400, FINGERPRINT)
+    return next(iter(first)), next(iter(second))
+
+
+def test_missing_all_without_details(airings):
+    for program in airings:
+        assert program.missing == ['details', 'cast', 'posters']
+
+
+def test_downloads_of_other_airing_count(airings):
+    first, second = airings
+
+    # Stages ran for the first airing only
+    first.stores.details[first.id] = details()
+    assert second.missing == ['cast', 'posters']
+
+    first.cast = models.tvguide.LeanShowsCast({'items': []})
+    assert second.missing == ['posters']
+
+    for image in first.details.images:
+        image.bucketType = 'local'
+    first.posters = ['key']
+    assert first.missing == second.missing == []
+
+
+def test_known_empty_downloads_not_missing(airings):
+    first, second = airings
+    first.stores.details[first.id] = None
+    assert second.missing == []
+
+    first.stores.details[first.id] = details(images=0)
+    first.cast = None
+    assert second.missing == []
+
+    first.stores.details[first.id] = details(mco_id=None, images=0)
+    first.stores.casts.clear()
+    assert second.missing == []
@@ -0,0 +1,177 @@
+from datetime import datetime, timezone
+
+import lxml.etree as ET
+import pytest
+
+from epg_xmltv import (TIME_FORMAT, XmltvReader, XmltvWriter, index_filepath, iter_children,
+                       merge_documents, render_parsed_element)
+
+HOUR = 3600
+START = 1700000000 // HOUR * HOUR
+
+
+def xmltv_time(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime(TIME_FORMAT)
+
+
+def channel(channel_id, name=None):
+    element = ET.Element('channel', id=channel_id)
+    ET.SubElement(element, 'display-name').text = name or channel_id
+    return render_parsed_element(element)
+
+
+def programme(channel_id, start, stop, title):
+    element = ET.Element('programme', start=xmltv_time(start), stop=xmltv_time(stop),
+                         channel=channel_id)
+    ET.SubElement(element, 'title').text = title
+    return render_parsed_element(element)
+
+
+def schedule(channel_id, hours, title=None):
+    """Programmes of channel an hour each, by start."""
+    return [(START + hour * HOUR, START + (hour + 1) * HOUR, f'{title or channel_id} {hour}')
+            for hour in range(hours)]
+
+
+def write_document(filepath, channels, names=None):
+    """Write document of `channels` schedules by channel ID, in order."""
+    with XmltvWriter(filepath, generator_info_name='test') as writer:
+        for channel_id in channels:
+            writer.write(channel(channel_id, (names or {}).get(channel_id)))
+        for channel_id, programmes in channels.items():
+            for start, stop, title in programmes:
+                writer.write_programme(programme(channel_id, start, stop, title),
+                                       channel_id, start, stop)
+    return filepath
+
+
+def parse(data):
+    return ET.fromstring(b'<tv>' + data + b'</tv>')
+
+
+def titles(data):
+    return [element.findtext('title') for element in parse(data)]
+
+
+@pytest.fixture
+def document(tmp_path):
+    return write_document(tmp_path / 'epg.xml', {'a': schedule('a', 4), 'b': schedule('b', 2)})
+
+
+def test_index_channel_slices(document):
+    with XmltvReader(document) as reader:
+        assert list(reader.channels) == ['a', 'b']
+        assert titles(reader.channel('a')) == ['a 0', 'a 1', 'a 2', 'a 3']
+        assert titles(reader.channel('b')) == ['b 0', 'b 1']
+        assert reader.span('a') == (START, START + 4 * HOUR)
+
+        # Programmes written one after another make a single range
+        assert len(reader.channels['a']['ranges']) == 1
+
+
+def test_index_matches_parsed_document(document):
+    children = iter_children(document)
+    next(children)
+    programmes = b''.join(render_parsed_element(element) for element in children
+                          if element.tag == 'programme')
+    with XmltvReader(document) as reader:
+        assert reader.channel('a') + reader.channel('b') == programmes
+
+
+def test_index_time_window(document):
+    with XmltvReader(document) as reader:
+        # Programmes ending at the start or starting at the stop are left out
+        found = list(reader.programmes(START + HOUR, START + 2 * HOUR + 1))
+        assert [(channel_id, titles(data)) for channel_id, data in found] == \
+            [('a', ['a 1']), ('a', ['a 2']), ('b', ['b 1'])]
+
+        found = list(reader.programmes(START, START + 3 * HOUR, channel_ids=['b', 'x']))
+        assert [titles(data) for _, data in found] == [['b 0'], ['b 1']]
+
+        assert list(reader.programmes(START + 10 * HOUR, START + 11 * HOUR)) == []
+
+
+def test_index_now_next(document):
+    with XmltvReader(document) as reader:
+        assert [titles(data) for data in reader.now_next('a', START + HOUR + 1)] == \
+            [['a 1'], ['a 2']]
+        assert [titles(data) for data in reader.now_next('a', START + 3 * HOUR)] == [['a 3']]
+        assert reader.now_next('a', START + 4 * HOUR) == []
+
+
+def test_index_unknown_channel(document):
+    with XmltvReader(document) as reader:
+        assert reader.channel('x') == b''
+        assert reader.now_next('x', START) == []
+        with pytest.raises(KeyError):
+            reader.span('x')
+
+
+def test_index_stale(document):
+    with document.open('ab') as f:
+        f.write(b'\n')
+
+    with pytest.raises(ValueError):
+        XmltvReader(document)
+
+
+def test_failed_document_keeps_previous(document):
+    index = index_filepath(document).read_bytes()
+    with pytest.raises(RuntimeError):
+        with XmltvWriter(document) as writer:
+            writer.write_programme(programme('a', START, START + HOUR, 'x'), 'a', START, START + HOUR)
+            raise RuntimeError()
+
+    assert index_filepath(document).read_bytes() == index
+    assert sorted(path.name for path in document.parent.iterdir()) == \
+        ['epg.xml', 'epg.xml.index.json']
+    with XmltvReader(document) as reader:
+        assert titles(reader.channel('a')) == ['a 0', 'a 1', 'a 2', 'a 3']
+
+
+def test_merge_shards(tmp_path):
+    first = write_document(tmp_path / 'first.xml', {
+        'a': schedule('a', 2),
+        'c': schedule('c', 2),
+    })
+    second = write_document(tmp_path / 'second.xml', {
+        'b': schedule('b', 2),
+        'c': schedule('c', 3, title='duplicate'),
+        'x': schedule('x', 1),
+    }, names={'c': 'duplicate'})
+
+    merged = tmp_path / 'merged.xml'
+    result = merge_documents(merged, [first, second], channel_ids=['b', 'a'])
+
+    # Listed channels go first, the rest by ID, duplicates come from the first shard
+    assert result.channel_ids == ['b', 'a', 'c', 'x']
+    assert result.programmes == 7
+    assert result.duplicates == 4
+
+    root = ET.parse(str(merged)).getroot()
+    assert root.get('generator-info-name') == 'test'
+    assert [(element.get('id'), element.findtext('display-name'))
+            for element in root.findall('channel')] == [('b', 'b'), ('a', 'a'), ('c', 'c'), ('x', 'x')]
+    assert [element.findtext('title') for element in root.findall('programme')] == \
+        ['b 0', 'b 1', 'a 0', 'a 1', 'c 0', 'c 1', 'x 0']
+
+    with XmltvReader(merged) as reader:
+        assert list(reader.channels) == ['b', 'a', 'c', 'x']
+        assert titles(reader.channel('c')) == ['c 0', 'c 1']
+        assert reader.span('c') == (START, START + 2 * HOUR)
+        assert [titles(data) for _, data in reader.programmes(START + HOUR, START + 2 * HOUR)] == \
+            [['b 1'], ['a 1'], ['c 1']]
+
+
+def test_merge_out_of_order_shards(tmp_path):
+    first = write_document(tmp_path / 'first.xml', {'a': schedule('a', 2)})
+    second = write_document(tmp_path / 'second.xml', {'b': schedule('b', 2)})
+
+    in_order = merge_documents(tmp_path / 'in-order.xml', [first, second], channel_ids=['a', 'b'])
+    out_of_order = merge_documents(tmp_path / 'out-of-order.xml', [second, first],
+                                   channel_ids=['a', 'b'])
+
+    assert in_order == out_of_order
+    assert (tmp_path / 'in-order.xml').read_bytes() == (tmp_path / 'out-of-order.xml').read_bytes()
+    assert index_filepath(tmp_path / 'in-order.xml').read_bytes() == \
+        index_filepath(tmp_path / 'out-of-order.xml').read_bytes()
@@ -2,7 +2,6 @@ import asyncio
 import json
 import logging
 import pathlib
-from functools import partial
 
 from tqdm.asyncio import tqdm
 
@@ -31,14 +30,48 @@ def load_dict(filename):
         return json.load(f)
 
 
-async def gather_with_concurrency(n, *tasks, show_progress=True, progress_title=None):
-    """Gather tasks with concurrency."""
-    semaphore = asyncio.Semaphore(n)
+async def run_pipeline(source, *stages, concurrency, queue_size=None, progress_title=None):
+    """Stream items from async iterable `source` through `stages`.
 
-    async def sem_task(task):
-        async with semaphore:
-            return await task
+    Every stage is an async callable served by its own pool of `concurrency`
+    workers, stages are connected with bounded queues, so an item enters
+    the next stage as soon as the previous one is done with it.
+    """
+    queues = [asyncio.Queue(maxsize=queue_size or concurrency * 2) for _ in stages]
+    done = object()  # End of stream marker
+    progress = tqdm(desc=progress_title)
 
-    gather = partial(tqdm.gather, desc=progress_title) if show_progress \
-        else asyncio.gather
-    return await gather(*[sem_task(x) for x in tasks])
+    async def feed():
+        async for item in source:
+            await queues[0].put(item)
+        for _ in range(concurrency):
+            await queues[0].put(done)
+
+    async def work(stage_idx):
+        stage, queue = stages[stage_idx], queues[stage_idx]
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            await stage(item)
+            if stage_idx + 1 < len(stages):
+                await queues[stage_idx + 1].put(item)
+            else:
+                progress.update()
+
+    async def run_stage(stage_idx):
+        await asyncio.gather(*[work(stage_idx) for _ in range(concurrency)])
+        if stage_idx + 1 < len(stages):
+            for _ in range(concurrency):
+                await queues[stage_idx + 1].put(done)
+
+    tasks = [asyncio.ensure_future(feed())]
+    tasks += [asyncio.ensure_future(run_stage(idx)) for idx in range(len(stages))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        progress.close()